@@ -9,30 +9,205 @@
 
 from datetime import datetime
 import matplotlib.pyplot as plt
-from meteostat import Point, Daily, Hourly
+import pandas as pd
+import numpy as np
+import hashlib
+import os
 
 class WeatherMeasurements:
 
+    # The measurements are cached locally (one npz file per source, location, sample periode and timezone).
+    # Requests only fetch the days, that are not cached yet. In the offline mode, nothing is fetched
+    # from the internet: requests are served from the cache or from the given (local) source.
+    #
+    def __init__(self, cache_dir='data/weather_cache', offline=False, source=None):
+
+        self.cache_dir = cache_dir
+        self.offline = offline
+        if source is None:
+            source = MeteostatSource()
+        self.source = source
+
     def get_data(self, startDate, endDate, lat, lon, alt, sample_periode, tz):
 
+        if sample_periode not in ('hourly', 'daily'):
+            raise ValueError("Invalid sample_periode chosen.")
+        if self.offline and not self.source.is_local:
+            source = None   # Only use the cache
+        else:
+            source = self.source
+
+        # Get the cached data and fetch the missing ranges
+        cache_path = self.get_cache_path(lat, lon, alt, sample_periode, tz)
+        cached = self.read_cache(cache_path)
+        missing_ranges = self.get_missing_ranges(cached, startDate, endDate)
+        if len(missing_ranges) > 0:
+            if source is None:
+                raise RuntimeError(f"Weather data from {startDate} to {endDate} is not cached at {cache_path} "
+                                   "and can't be fetched in offline mode.")
+            for range_start, range_end in missing_ranges:
+                new_data = source.fetch(lat, lon, alt, range_start, range_end, sample_periode, tz)
+                cached = self.merge(cached, new_data, range_start, range_end)
+            if self.cache_dir is not None:
+                self.write_cache(cache_path, cached)
+
+        # Select the requested range
+        self.data = cached['data']
+        self.data = self.data[(self.data.index >= self.localize(startDate, self.data.index.tz)) &
+                              (self.data.index <= self.localize(endDate, self.data.index.tz))].copy()
+
+        # Replace NaN values with zero (if there are any)
+        self.data.fillna(0, inplace=True)
+
+        # Check the timezone
+        assert str(self.data.index.tz) == str(tz), f"Expected tz = {tz}, received tz = {self.data.index.tz}"
+
+        return self.data
+
+    # Return the ranges of the requested period, which are not covered by the cache.
+    #
+    def get_missing_ranges(self, cached, startDate, endDate):
+
+        if cached is None:
+            return [(startDate, endDate)]
+
+        missing_ranges = []
+        if startDate < cached['start']:
+            missing_ranges.append((startDate, cached['start']))
+        if endDate > cached['end']:
+            missing_ranges.append((cached['end'], endDate))
+
+        return missing_ranges
+
+    # Add the newly fetched data (of the given range) to the cached data.
+    #
+    def merge(self, cached, new_data, range_start, range_end):
+
+        if cached is None:
+            return {'data': new_data, 'start': range_start, 'end': range_end}
+
+        data = pd.concat([cached['data'], new_data])
+        data = data[~data.index.duplicated(keep='last')].sort_index()
+        merged = {
+            'data': data,
+            'start': min(cached['start'], range_start),
+            'end': max(cached['end'], range_end),
+        }
+        return merged
+
+    def get_cache_path(self, lat, lon, alt, sample_periode, tz):
+        if self.cache_dir is None:
+            return None
+        # The data of different sources (e.g. meteostat and a local file) is cached separately
+        cache_name = f"{self.source.get_id()}_{sample_periode}_{lat}_{lon}_{alt}_{tz}".replace('/', '-')
+        return os.path.join(self.cache_dir, cache_name + '.npz')
+
+    def read_cache(self, cache_path):
+
+        if cache_path is None or not os.path.exists(cache_path):
+            return None
+
+        with np.load(cache_path, allow_pickle=False) as cache:
+            index = pd.to_datetime(cache['index'], utc=True)
+            if str(cache['tz']) != 'None':
+                index = index.tz_convert(str(cache['tz']))
+            else:
+                index = index.tz_localize(None)
+            data = pd.DataFrame(cache['values'], index=index, columns=cache['columns'].tolist())
+            cached = {
+                'data': data,
+                'start': datetime.fromisoformat(str(cache['start'])),
+                'end': datetime.fromisoformat(str(cache['end'])),
+            }
+        return cached
+
+    # Write the cache atomically, i.e. readers never see partially written files.
+    #
+    def write_cache(self, cache_path, cached):
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data = cached['data']
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path,
+                 index=data.index.asi8 if data.index.tz is None else data.index.tz_convert('UTC').asi8,
+                 values=data.to_numpy(dtype=np.float64),
+                 columns=np.array(data.columns, dtype=str),
+                 tz=str(data.index.tz),
+                 start=cached['start'].isoformat(),
+                 end=cached['end'].isoformat(),
+                 )
+        os.replace(tmp_path, cache_path)
+
+    @staticmethod
+    def localize(date, tz):
+        timestamp = pd.Timestamp(date)
+        if tz is not None and timestamp.tzinfo is None:
+            timestamp = timestamp.tz_localize(tz)
+        return timestamp
+
+
+# Fetch the weather measurements from meteostat.
+#
+class MeteostatSource:
+
+    is_local = False
+
+    def get_id(self):
+        return 'meteostat'
+
+    def fetch(self, lat, lon, alt, startDate, endDate, sample_periode, tz):
+
+        from meteostat import Point, Daily, Hourly
+
         # Create Geo-Point
         location = Point(lat, lon, alt)
 
         # Specify sampling periode
         if sample_periode == 'hourly':
-            self.data = Hourly(location, startDate, endDate, tz)
+            data = Hourly(location, startDate, endDate, tz)
         elif sample_periode == 'daily':
-            self.data = Daily(location, startDate, endDate, tz)
+            data = Daily(location, startDate, endDate, tz)
         else:
             raise ValueError("Invalid sample_periode chosen.")
 
         # Download selected data
-        self.data = self.data.fetch()
+        return data.fetch()
 
-        # Replace NaN values with zero (if there are any)
-        self.data.fillna(0, inplace=True)
 
-        # Check the timezone
-        assert str(self.data.index.tz) == str(tz), f"Expected tz = {tz}, received tz = {self.data.index.tz}"
+# Read the weather measurements from a local file (e.g. an export of the meteostat data),
+# as stand-in for meteostat on machines without internet access.
+# Supported are pickled DataFrames, parquet and csv files with the timestamps as (first) index.
+#
+class LocalFileSource:
 
-        return self.data
+    is_local = True
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    # The id changes with the path, the size and the modification time of the file
+    #
+    def get_id(self):
+        stat = os.stat(self.path)
+        file_identity = f"{os.path.abspath(self.path)}_{stat.st_size}_{stat.st_mtime_ns}"
+        return 'local_' + hashlib.sha256(file_identity.encode()).hexdigest()[:16]
+
+    def fetch(self, lat, lon, alt, startDate, endDate, sample_periode, tz):
+
+        if self.data is None:
+            if self.path.endswith('.pkl'):
+                self.data = pd.read_pickle(self.path)
+            elif self.path.endswith('.parquet'):
+                self.data = pd.read_parquet(self.path)
+            else:
+                self.data = pd.read_csv(self.path, index_col=0, parse_dates=True)
+
+        data = self.data
+        if data.index.tz is None:
+            data = data.tz_localize(tz)
+        else:
+            data = data.tz_convert(tz)
+
+        return data[(data.index >= WeatherMeasurements.localize(startDate, tz)) &
+                    (data.index <= WeatherMeasurements.localize(endDate, tz))]
@@ -0,0 +1,306 @@
+import time
+import io
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader, TensorDataset
+import subprocess
+import sys
+import os
+
+# Make sure, that the root of the project is already in PYTHONPATH.
+#
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+# Imports own modules.
+# All imports are done relative to the root of the project.
+#
+import scripts.Model as model
+import scripts.Simulation_config as config
+import scripts.FeatureStore as FeatureStore
+
+
+# Measure the training and inference performance of the models on random data with the
+# shape of the model data (nr_of_batches, timesteps, features).
+# Alternatively, the data of a preprocessed load profile of the feature store is used 
+# (e.g. load_profile='scripts/outputs/file_0.pkl' after a run of the standard config).
+#
+class Benchmark:
+
+    def __init__(self, nr_of_samples=365, timesteps=24, num_of_features=20, batch_size=256, repetitions=3, 
+                 load_profile=None):
+        self.batch_size = batch_size
+        self.repetitions = repetitions
+        self.modelAdapter = None
+        if load_profile is None:
+            torch.manual_seed(0)
+            self.X = torch.randn(nr_of_samples, timesteps, num_of_features)
+            self.Y = torch.randn(nr_of_samples, timesteps, 1)
+            self.X_test = torch.randn(nr_of_samples // 4, timesteps, num_of_features)
+            self.Y_test = torch.randn(nr_of_samples // 4, timesteps, 1)
+        else:
+            self.X, self.Y, self.X_test, self.Y_test, self.modelAdapter = self.read_data(load_profile)
+        self.num_of_features = self.X.shape[2]
+
+    # Return the train and test data of the given preprocessed load profile of the feature store.
+    #
+    @staticmethod
+    def read_data(load_profile):
+        X, Y, modelAdapter = FeatureStore.FeatureStore().read(load_profile)
+        return X['train'], Y['train'], X['test'], Y['test'], modelAdapter
+
+    # Return all model sizes of the simulation config.
+    #
+    @staticmethod
+    def get_model_sizes():
+        return [value for name, value in vars(config.ModelSize).items() if not name.startswith('__')]
+
+    # Return the wall time of one training epoch (best of the repetitions) with the given batch iterator.
+    #
+    def measure_epoch_time(self, model_type, model_size, batch_iterator):
+
+        torch.manual_seed(0)
+        myModel = model.Model(model_type, model_size, self.num_of_features)
+        my_optimizer = optim.Adam(myModel.my_model.parameters(), lr=0.001)
+        myModel.my_model.train()
+
+        epoch_times = []
+        for repetition in range(self.repetitions + 1):     # The first epoch is a warm-up
+            start_time = time.perf_counter()
+            for batch_x, batch_y in batch_iterator:
+                my_optimizer.zero_grad()
+                loss = myModel.loss_fn(myModel.my_model(batch_x), batch_y)
+                loss.backward()
+                my_optimizer.step()
+            epoch_times.append(time.perf_counter() - start_time)
+
+        return min(epoch_times[1:])
+
+    # Compare the epoch time of the DataLoader with the TensorBatchIterator for every model size.
+    #
+    def run_batch_iterator_benchmark(self, model_types=('LSTM', 'Transformer', 'xLSTM')):
+
+        batch_iterators = {
+            'DataLoader': DataLoader(TensorDataset(self.X, self.Y), batch_size=self.batch_size, shuffle=True),
+            'TensorBatchIterator': model.TensorBatchIterator(self.X, self.Y, self.batch_size, shuffle=True),
+        }
+
+        results = {}
+        print(f"{'model':<12} {'size':<5} " + " ".join(f"{name:>20}" for name in batch_iterators) + f" {'speedup':>8}")
+        for model_type in model_types:
+            for model_size in self.get_model_sizes():
+                epoch_times = {name: self.measure_epoch_time(model_type, model_size, batch_iterator)
+                               for name, batch_iterator in batch_iterators.items()}
+                results[(model_type, model_size)] = epoch_times
+                speedup = epoch_times['DataLoader'] / epoch_times['TensorBatchIterator']
+                print(f"{model_type:<12} {model_size:<5} "
+                      + " ".join(f"{epoch_time*1000:>18.1f}ms" for epoch_time in epoch_times.values())
+                      + f" {speedup:>7.2f}x", flush=True)
+
+        return results
+
+    # Train every model with fp32 and with bf16 autocast (from the same initial weights) and compare
+    # the mean epoch time and the de-normalized test loss. Per default, the first load profile of the
+    # standard config is used (i.e. after a run of the ModelTrainer). With load_profile=None, the data 
+    # of this benchmark is used instead.
+    #
+    def run_precision_benchmark(self, model_types=('LSTM', 'Transformer', 'xLSTM'), model_sizes=('5k', '40k', '80k'), 
+                                epochs=20, load_profile='scripts/outputs/file_0.pkl'):
+
+        if load_profile is None:
+            X, Y, X_test, Y_test, modelAdapter = self.X, self.Y, self.X_test, self.Y_test, self.modelAdapter
+        else:
+            X, Y, X_test, Y_test, modelAdapter = self.read_data(load_profile)
+        num_of_features = X.shape[2]
+
+        results = {}
+        print(f"{'model':<12} {'size':<5} {'fp32 epoch':>11} {'bf16 epoch':>11} {'speedup':>8} "
+              f"{'fp32 loss':>10} {'bf16 loss':>10} {'delta':>8}")
+        for model_type in model_types:
+            for model_size in model_sizes:
+                torch.manual_seed(0)
+                initial_model = model.Model(model_type, model_size, num_of_features, modelAdapter)
+                initial_weights = initial_model.my_model.state_dict()
+
+                result = {}
+                for precision in ('fp32', 'bf16'):
+                    torch.manual_seed(1)
+                    myModel = model.Model(model_type, model_size, num_of_features, modelAdapter)
+                    myModel.my_model.load_state_dict(initial_weights)
+                    history = myModel.train_model(X, Y, finetune_now=False, epochs=epochs, 
+                                                  batch_size=self.batch_size, precision=precision)
+                    history = myModel.evaluate(X_test, Y_test, results=history, 
+                                               deNormalize=modelAdapter is not None, precision=precision)
+                    epoch_times = history['telemetry']['epoch_time'][1:]    # Without the warm-up epoch
+                    result[precision] = {
+                        'epoch_time': sum(epoch_times) / max(len(epoch_times), 1),
+                        'test_loss': history['test_loss'][-1],
+                        'bf16_supported': myModel.bf16_supported,
+                    }
+                results[(model_type, model_size)] = result
+
+                fp32, bf16 = result['fp32'], result['bf16']
+                print(f"\r{model_type:<12} {model_size:<5} {fp32['epoch_time']*1000:>9.1f}ms "
+                      f"{bf16['epoch_time']*1000:>9.1f}ms {fp32['epoch_time']/bf16['epoch_time']:>7.2f}x "
+                      f"{fp32['test_loss']:>10.4f} {bf16['test_loss']:>10.4f} "
+                      f"{bf16['test_loss'] - fp32['test_loss']:>+8.4f}" 
+                      + ("" if bf16['bf16_supported'] else " (fp32 fallback)"), flush=True)
+
+        return results
+
+    # Compare the inference latency of the eager model with the compiled models for every model size.
+    # The compilation time (first call) is reported separately and not included in the latency.
+    #
+    def run_compiled_inference_benchmark(self, model_types=('LSTM', 'Transformer', 'xLSTM'), 
+                                         compile_modes=(None, 'trace', 'compile'), batch_size=7, repetitions=50):
+
+        x = self.X[:batch_size].float()
+        results = {}
+        print(f"{'model':<12} {'size':<5} " + " ".join(f"{str(mode):>10} {'(build)':>8}" for mode in compile_modes))
+        for model_type in model_types:
+            for model_size in self.get_model_sizes():
+                torch.manual_seed(0)
+                torch._dynamo.reset()   # Otherwise, the models of all sizes count to the same recompile limit
+                myModel = model.Model(model_type, model_size, self.num_of_features)
+                result = {}
+                for compiled in compile_modes:
+                    start_time = time.perf_counter()
+                    myModel.predict(x, compiled=compiled)      # Compile and warm-up
+                    build_time = time.perf_counter() - start_time
+                    
+                    start_time = time.perf_counter()
+                    for repetition in range(repetitions):
+                        myModel.predict(x, compiled=compiled)
+                    latency = (time.perf_counter() - start_time) / repetitions
+                    result[compiled] = {'latency': latency, 'build_time': build_time}
+                results[(model_type, model_size)] = result
+                print(f"{model_type:<12} {model_size:<5} " 
+                      + " ".join(f"{result[mode]['latency']*1000:>8.2f}ms {result[mode]['build_time']:>7.1f}s" 
+                                 for mode in compile_modes), flush=True)
+
+        return results
+
+    # Export every model to ONNX (including the parity check against torch) and compare the torch model 
+    # with the OnnxPredictor:
+    #   - startup: time of a fresh python process, which loads the model and predicts one batch
+    #   - latency: mean time of one prediction in this process
+    #
+    def run_onnx_benchmark(self, model_types=('LSTM', 'Transformer', 'xLSTM'), model_sizes=('5k', '40k', '80k'), 
+                           batch_size=7, repetitions=50, export_dir='scripts/outputs/onnx'):
+
+        # Only this benchmark needs onnxruntime
+        import scripts.OnnxPredictor as OnnxPredictor
+
+        x = self.X[:batch_size].float()
+        if self.modelAdapter is not None:
+            x = x * torch.as_tensor(self.modelAdapter.stdX) + torch.as_tensor(self.modelAdapter.meanX)
+        os.makedirs(export_dir, exist_ok=True)
+        input_path = os.path.join(export_dir, 'benchmark_input.pt')
+        torch.save(x, input_path)
+
+        results = {}
+        print(f"{'model':<12} {'size':<5} {'torch start':>12} {'onnx start':>11} {'torch pred':>11} "
+              f"{'onnx pred':>10} {'max diff':>9}")
+        for model_type in model_types:
+            for model_size in model_sizes:
+                torch.manual_seed(0)
+                myModel = model.Model(model_type, model_size, self.num_of_features, self.modelAdapter)
+                onnx_path = myModel.export_onnx(os.path.join(export_dir, f'{model_type}_{model_size}.onnx'))
+                torch_model = myModel.get_normalized_model() if self.modelAdapter is not None else myModel.my_model
+                torch_model.eval()
+                state_dict_path = os.path.join(export_dir, f'{model_type}_{model_size}.pth')
+                torch.save(myModel.my_model.state_dict(), state_dict_path)
+                predictor = OnnxPredictor.OnnxPredictor(onnx_path)
+
+                # Startup of a serving process (the normalization is negligible for the torch model)
+                torch_startup = self.measure_startup_time(
+                    "import torch; import scripts.Model as model; "
+                    f"myModel = model.Model('{model_type}', '{model_size}', {self.num_of_features}); "
+                    f"myModel.my_model.load_state_dict(torch.load('{state_dict_path}')); "
+                    f"myModel.predict(torch.load('{input_path}'))")
+                onnx_startup = self.measure_startup_time(
+                    "import numpy as np; import scripts.OnnxPredictor as OnnxPredictor; "
+                    f"OnnxPredictor.OnnxPredictor('{onnx_path}').predict(np.zeros({tuple(x.shape)}, dtype=np.float32))")
+
+                # Prediction latency
+                with torch.no_grad():
+                    torch_output = torch_model(x).numpy()
+                    start_time = time.perf_counter()
+                    for repetition in range(repetitions):
+                        torch_model(x)
+                    torch_latency = (time.perf_counter() - start_time) / repetitions
+                onnx_output = predictor.predict(x.numpy())
+                start_time = time.perf_counter()
+                for repetition in range(repetitions):
+                    predictor.predict(x.numpy())
+                onnx_latency = (time.perf_counter() - start_time) / repetitions
+
+                result = {
+                    'torch_startup': torch_startup, 'onnx_startup': onnx_startup,
+                    'torch_latency': torch_latency, 'onnx_latency': onnx_latency,
+                    'max_diff': float(abs(torch_output - onnx_output).max()),
+                }
+                results[(model_type, model_size)] = result
+                print(f"{model_type:<12} {model_size:<5} {torch_startup:>11.2f}s {onnx_startup:>10.2f}s "
+                      f"{torch_latency*1000:>9.2f}ms {onnx_latency*1000:>8.2f}ms {result['max_diff']:>9.1e}", flush=True)
+
+        return results
+
+    # Train every model (fp32), quantize it dynamically to int8 and compare the size of the state_dict, 
+    # the prediction latency and the nMAE on the test data (i.e. the MAE relative to the mean load in %).
+    #
+    def run_quantization_benchmark(self, model_types=('LSTM', 'Transformer'), model_sizes=('5k', '40k', '80k'), 
+                                   epochs=20, batch_size=7, repetitions=50):
+
+        x = self.X_test[:batch_size].float()
+        results = {}
+        print(f"{'model':<12} {'size':<5} {'fp32 size':>10} {'int8 size':>10} {'fp32 pred':>10} {'int8 pred':>10} "
+              f"{'fp32 nMAE':>10} {'int8 nMAE':>10} {'delta':>7}")
+        for model_type in model_types:
+            for model_size in model_sizes:
+                torch.manual_seed(0)
+                myModel = model.Model(model_type, model_size, self.num_of_features, self.modelAdapter)
+                myModel.train_model(self.X, self.Y, finetune_now=False, epochs=epochs, batch_size=self.batch_size)
+                quantizedModel = myModel.quantize()
+
+                result = {}
+                for name, evaluatedModel in [('fp32', myModel), ('int8', quantizedModel)]:
+                    state_dict_file = io.BytesIO()
+                    torch.save(evaluatedModel.my_model.state_dict(), state_dict_file)
+
+                    evaluatedModel.predict(x)      # Warm-up
+                    start_time = time.perf_counter()
+                    for repetition in range(repetitions):
+                        evaluatedModel.predict(x)
+                    latency = (time.perf_counter() - start_time) / repetitions
+
+                    history = evaluatedModel.evaluate(self.X_test, self.Y_test, results={}, 
+                                                      deNormalize=self.modelAdapter is not None)
+                    result[name] = {
+                        'size': len(state_dict_file.getvalue()),
+                        'latency': latency,
+                        'nMAE': history['test_loss_relative'][-1],
+                    }
+                results[(model_type, model_size)] = result
+
+                fp32, int8 = result['fp32'], result['int8']
+                print(f"\r{model_type:<12} {model_size:<5} {fp32['size']/1024:>8.1f}kB {int8['size']/1024:>8.1f}kB "
+                      f"{fp32['latency']*1000:>8.2f}ms {int8['latency']*1000:>8.2f}ms "
+                      f"{fp32['nMAE']:>9.2f}% {int8['nMAE']:>9.2f}% {int8['nMAE'] - fp32['nMAE']:>+7.2f}", flush=True)
+
+        return results
+
+    # Return the wall time of a fresh python process (in the project root), which runs the given code.
+    #
+    @staticmethod
+    def measure_startup_time(code):
+
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=parent_dir, check=True, 
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    Benchmark().run_batch_iterator_benchmark()
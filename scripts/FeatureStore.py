@@ -0,0 +1,323 @@
+import numpy as np
+import pandas as pd
+import torch
+import pickle
+import shutil
+import hashlib
+import json
+import os
+from demandlib import bdew
+
+import scripts.ModelAdapter as ModelAdapter
+
+# Persist the preprocessed model data (X, Y and the ModelAdapter) of the load profiles.
+#
+# Every entry is a directory with the raw X and Y arrays as .npy files and a small metadata
+# file with the ModelAdapter (i.e. the normalization statistics) and the split indices.
+# Reading maps the arrays into memory, so loading an entry is independent of its size and
+# several processes share the same pages through the OS page cache.
+#
+class FeatureStore:
+
+    def __init__(self, path='scripts/outputs/features', encoding=np.float32):
+        self.path = path
+        self.encoding = encoding    # On-disk floating point type, e.g. np.float16 for large community sets
+
+    # Store the given model data under the given name.
+    #
+    def write(self, name, X, Y, modelAdapter):
+
+        # Write to a temporary directory first, so that readers never see partial entries
+        entry_path = self.getEntryPath(name)
+        tmp_path = entry_path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        X_data, Y_data = self.toNumpy(X.data), self.toNumpy(Y.data)
+        np.save(os.path.join(tmp_path, 'X.npy'), X_data)
+        np.save(os.path.join(tmp_path, 'Y.npy'), Y_data)
+        metadata = {
+            'modelAdapter': modelAdapter,
+            'split_indices': X.split_indices,
+            'dtype': np.dtype(modelAdapter.dtype).str,
+            'content_hash': self.getArrayHash(X_data, Y_data),
+        }
+        with open(os.path.join(tmp_path, 'metadata.pkl'), 'wb') as file:
+            pickle.dump(metadata, file)
+
+        shutil.rmtree(entry_path, ignore_errors=True)
+        os.replace(tmp_path, entry_path)
+
+        return name
+
+    # Load the model data with the given name.
+    # With the default float32 encoding, the returned tensors directly use the memory-mapped files.
+    # Other encodings are decoded to the dtype of the ModelAdapter (i.e. one copy in memory).
+    #
+    def read(self, name):
+
+        entry_path = self.getEntryPath(name)
+        with open(os.path.join(entry_path, 'metadata.pkl'), 'rb') as file:
+            metadata = pickle.load(file)
+
+        # Copy-on-write mapping, i.e. the pages are shared until a process modifies them
+        X_all = np.load(os.path.join(entry_path, 'X.npy'), mmap_mode='c')
+        Y_all = np.load(os.path.join(entry_path, 'Y.npy'), mmap_mode='c')
+        if X_all.dtype != np.dtype(metadata['dtype']):
+            X_all = X_all.astype(metadata['dtype'])
+            Y_all = Y_all.astype(metadata['dtype'])
+
+        X = ModelAdapter.DatasetSplits(torch.from_numpy(X_all), metadata['split_indices'])
+        Y = ModelAdapter.DatasetSplits(torch.from_numpy(Y_all), metadata['split_indices'])
+
+        return X, Y, metadata['modelAdapter']
+
+    def contains(self, name):
+        return os.path.exists(os.path.join(self.getEntryPath(name), 'metadata.pkl'))
+
+    # Return the hash of the X and Y data of the given entry, which identifies the data by its content.
+    #
+    def getContentHash(self, name):
+
+        entry_path = self.getEntryPath(name)
+        with open(os.path.join(entry_path, 'metadata.pkl'), 'rb') as file:
+            metadata = pickle.load(file)
+        if 'content_hash' in metadata:
+            return metadata['content_hash']
+
+        # Entries of older versions don't contain the hash yet
+        return self.getArrayHash(np.load(os.path.join(entry_path, 'X.npy'), mmap_mode='r'), 
+                                 np.load(os.path.join(entry_path, 'Y.npy'), mmap_mode='r'))
+
+    @staticmethod
+    def getArrayHash(*arrays):
+
+        array_hash = hashlib.sha256()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            array_hash.update(f'{array.dtype.str}{array.shape}'.encode())
+            array_hash.update(memoryview(array).cast('B'))
+
+        return array_hash.hexdigest()[:32]
+
+    # Return the directory of the given entry name.
+    # Names can also be file paths (e.g. 'scripts/outputs/file_0.pkl'), then only the file stem is used.
+    #
+    def getEntryPath(self, name):
+        entry_name = os.path.splitext(os.path.basename(name))[0]
+        return os.path.join(self.path, entry_name)
+
+    # Return the given data as numpy array in the on-disk encoding.
+    #
+    def toNumpy(self, data):
+        if torch.is_tensor(data):
+            data = data.numpy()
+        return np.ascontiguousarray(data, dtype=self.encoding)
+
+
+# Cache the preprocessed profiles of whole simulation runs, so that runs which share the same
+# data (e.g. which only differ in the model size or the epochs) skip the preprocessing.
+#
+# The cache is content-addressed: the key is a hash of all settings that affect the preprocessing
+# (including size and modification time of the source file). The entries are hard links to the
+# files of the FeatureStore, so storing and restoring don't copy any data (if possible).
+# The least recently used entries are evicted, if the total size exceeds the given limit.
+#
+class PreprocessingCache:
+
+    def __init__(self, path='scripts/outputs/preprocessing_cache', max_size_bytes=20*1024**3):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+
+    # Return the cache key of the given preprocessing settings.
+    # The source files are identified by their path, size and modification time.
+    #
+    def getKey(self, settings, source_files=()):
+
+        key_data = {name: str(value) for name, value in sorted(settings.items())}
+        for source_file in source_files:
+            file_stat = os.stat(source_file)
+            key_data[f'source:{source_file}'] = f'{file_stat.st_size}:{file_stat.st_mtime_ns}'
+
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()[:32]
+
+    def contains(self, key):
+        return os.path.exists(self.getManifestPath(key))
+
+    # Store the given entries of the feature store under the given key.
+    #
+    def store(self, key, featureStore, names):
+
+        cache_path = os.path.join(self.path, key)
+        tmp_path = cache_path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        for name in names:
+            self.linkDirectory(featureStore.getEntryPath(name), 
+                               os.path.join(tmp_path, os.path.basename(featureStore.getEntryPath(name))))
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as file:
+            json.dump({'names': list(names)}, file)
+
+        shutil.rmtree(cache_path, ignore_errors=True)
+        os.replace(tmp_path, cache_path)
+        self.evict(keep=key)
+
+    # Restore the entries of the given key into the feature store and return their names.
+    #
+    def restore(self, key, featureStore):
+
+        cache_path = os.path.join(self.path, key)
+        with open(self.getManifestPath(key), 'r') as file:
+            names = json.load(file)['names']
+
+        for name in names:
+            entry_path = featureStore.getEntryPath(name)
+            tmp_path = entry_path + '.tmp'
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            self.linkDirectory(os.path.join(cache_path, os.path.basename(entry_path)), tmp_path)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            os.replace(tmp_path, entry_path)
+
+        # Mark the entry as recently used
+        os.utime(self.getManifestPath(key))
+
+        return names
+
+    # Delete the least recently used entries, until the cache fits into the size limit.
+    #
+    def evict(self, keep=None):
+
+        entries = []
+        for key in os.listdir(self.path):
+            if self.contains(key):
+                entry_path = os.path.join(self.path, key)
+                entry_size = sum(os.path.getsize(os.path.join(root, file)) 
+                                 for root, _, files in os.walk(entry_path) for file in files)
+                entries.append((os.path.getmtime(self.getManifestPath(key)), key, entry_size))
+
+        total_size = sum(entry_size for _, _, entry_size in entries)
+        for _, key, entry_size in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+                total_size -= entry_size
+
+    def getManifestPath(self, key):
+        return os.path.join(self.path, key, 'manifest.json')
+
+    # Recreate the given directory with hard links to its files (or copies, if linking fails).
+    #
+    @staticmethod
+    def linkDirectory(source_path, target_path):
+
+        os.makedirs(target_path)
+        for file in os.listdir(source_path):
+            try:
+                os.link(os.path.join(source_path, file), os.path.join(target_path, file))
+            except OSError:
+                shutil.copy2(os.path.join(source_path, file), os.path.join(target_path, file))
+
+
+# Store the weights of the pretrained models.
+#
+# The store is content-addressed: the key is a hash of everything that determines the pretrained weights
+# (model class, model size, number of features, pretraining data, epochs and training options). So configs with the same 
+# pretraining share the weights, while e.g. configs with other model sizes never overwrite each other 
+# and parallel runs never load incompatible weights.
+#
+class PretrainedWeightsStore:
+
+    def __init__(self, path='scripts/outputs/pretrained_weights'):
+        self.path = path
+
+    # Return the key of the pretrained weights. The training options (e.g. the precision) 
+    # are part of the key, as they change the resulting weights.
+    #
+    def getKey(self, model_type, model_size, num_of_features, data_hash, epochs, training_options={}):
+
+        key_data = {
+            'model_type': model_type,
+            'model_size': str(model_size),
+            'num_of_features': int(num_of_features),
+            'data_hash': data_hash,
+            'epochs': int(epochs),
+            'training_options': {name: str(value) for name, value in sorted(training_options.items())},
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()[:32]
+
+    def contains(self, key):
+        return os.path.exists(self.getPath(key))
+
+    # Store the given state_dict atomically, i.e. parallel runs never read partially written weights.
+    #
+    def write(self, key, state_dict):
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f'{self.getPath(key)}.{os.getpid()}.tmp'
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, self.getPath(key))
+
+    def read(self, key):
+        return torch.load(self.getPath(key))
+
+    def getPath(self, key):
+        return os.path.join(self.path, f'{key}.pth')
+
+
+# Cache the BDEW standard load profiles per year.
+#
+# Generating a year with demandlib takes a while and the result only depends on the year and its
+# public holidays, so every generated year is kept in memory and as npz file on disk.
+#
+class StandardLoadProfileStore:
+
+    def __init__(self, path='scripts/outputs/standard_loadprofiles', profile_type='h0', annual_demand=1000):
+        self.path = path
+        self.profile_type = profile_type
+        self.annual_demand = annual_demand
+        self.cached_years = {}
+
+    # Return the standard load profile from startDate to endDate (both naive datetimes) in UTC.
+    #
+    def getProfile(self, startDate, endDate, public_holidays):
+
+        standard_loadprofiles = [self.getYear(year, public_holidays) 
+                                 for year in range(startDate.year, endDate.year + 1)]
+        all_standard_loadprofiles = pd.concat(standard_loadprofiles)
+        all_standard_loadprofiles = all_standard_loadprofiles[(all_standard_loadprofiles.index >= startDate)
+                                                                & (all_standard_loadprofiles.index <= endDate)]
+        all_standard_loadprofiles = all_standard_loadprofiles.tz_localize("UTC")
+
+        return all_standard_loadprofiles
+
+    # Return the standard load profile of the given year (with a naive datetime index).
+    #
+    def getYear(self, year, public_holidays):
+
+        # Only the holidays of the given year affect its profile
+        holidays_of_year = tuple(sorted(pd.Timestamp(holiday).value for holiday in public_holidays 
+                                        if pd.Timestamp(holiday).year == year))
+        key = (year, self.profile_type, self.annual_demand, holidays_of_year)
+        if key in self.cached_years:
+            return self.cached_years[key]
+
+        key_hash = hashlib.sha256(str(key).encode()).hexdigest()[:16]
+        year_path = os.path.join(self.path, f'{self.profile_type}_{year}_{key_hash}.npz')
+        if os.path.exists(year_path):
+            with np.load(year_path) as cached:
+                profile = pd.Series(cached['values'], index=pd.to_datetime(cached['index']), 
+                                    name=self.profile_type)
+        else:
+            profile = bdew.ElecSlp(year, holidays=public_holidays).get_profile({self.profile_type: self.annual_demand})
+            profile = profile[self.profile_type]
+
+            # Write atomically, as several runs may share the store
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = year_path + '.tmp.npz'
+            np.savez(tmp_path, index=profile.index.asi8, values=profile.to_numpy())
+            os.replace(tmp_path, year_path)
+
+        self.cached_years[key] = profile
+        return profile
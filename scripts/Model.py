@@ -1,11 +1,20 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, Dataset
+import torch.nn.functional as F
+from torch.func import stack_module_state, functional_call, vmap
+import copy
+import contextlib
+import inspect
+import time
+import resource
+import sys
+import os
+import warnings
 from torch.autograd import Variable
 import numpy as np
+import pandas as pd
 import scripts.Simulation_config as config
-import pickle
 from xlstm import (
     xLSTMBlockStack,
     xLSTMBlockStackConfig,
@@ -18,11 +27,14 @@ from xlstm import (
 
 
 class Model():
-    def __init__(self, model_type, model_size, num_of_features, modelAdapter=None):
+    def __init__(self, model_type, model_size, num_of_features, modelAdapter=None, standardLoadProfile=None):
         
         if model_type not in globals():
             # No class with name model_type is implemented below
             raise ValueError(f"Unexpected 'model_type' parameter received: {model_type}")
+        elif model_type == 'SyntheticLoadProfile':
+            # Only this model needs the (transformed) standard load profile, i.e. (Y, modelAdapter)
+            self.my_model = SyntheticLoadProfile(model_size, num_of_features, modelAdapter, standardLoadProfile)
         else:
             # Instantiate the model
             my_model_class = globals()[model_type]        
@@ -31,23 +43,70 @@ class Model():
         # Member Variables
         self.loss_fn = nn.L1Loss()   # Optional: nn.L1Loss(), nn.MSE(), self.smape, ...
         self.modelAdapter = modelAdapter
+        self.num_of_features = num_of_features
+        self.bf16_supported = True   # Is set to False, if the model fails with bfloat16 autocast
+        self.compiled_models = {}    # Compiled inference models per input shape (see get_compiled_model)
 
     # Predict Y from the given X.
+    # The dates of the predicted days are only needed by the SyntheticLoadProfile.
+    # Optionally, the pytorch models run compiled (compiled='trace' or 'compile', see get_compiled_model).
     #
-    def predict(self, X):
+    def predict(self, X, dates=None, precision='fp32', compiled=None):
         
         if self.my_model.isPytorchModel == True:            
             # Machine Learning Model            
             self.my_model.eval()  
             with torch.no_grad():
-                output = self.my_model.forward(X.float())
+                output = self.forward_with_precision(X.float(), precision, compiled)
                 
         else:
             # Simple models
-            output = self.my_model.forward(X)
+            output = self.my_model.forward(X, dates=dates)
             
         return output
     
+    # Return the model output for the given input with the given precision:
+    #   - 'fp32': float32 weights and computations
+    #   - 'bf16': CPU autocast to bfloat16 (the weights stay float32). 
+    # If the model doesn't support bfloat16 (e.g. an op without bf16 kernel), fp32 is used instead.
+    #
+    def forward_with_precision(self, x, precision='fp32', compiled=None):
+
+        forward = lambda x, precision: self.get_compiled_model(x, precision, compiled)(x)
+        return forward_with_autocast(forward, x, precision, [self])
+
+    # Return the inference model for the given input, which is compiled once per input shape and precision:
+    #   - None: the eager model (no compilation)
+    #   - 'trace': TorchScript trace of the model (cheap to create, removes the python dispatch overhead)
+    #   - 'compile': torch.compile with the inductor backend (slow to create, needs a C++ compiler)
+    # Both variants share the parameters with self.my_model, so they stay valid after further training.
+    # The Transformer is traced in eval mode without gradients, i.e. the compiled model uses the fused 
+    # encoder fast path of pytorch (torch._transformer_encoder_layer_fwd).
+    #
+    def get_compiled_model(self, x, precision='fp32', compiled=None):
+
+        if compiled is None:
+            return self.my_model
+
+        key = (compiled, precision, tuple(x.shape), x.dtype)
+        if key not in self.compiled_models:
+            assert not self.my_model.training and not torch.is_grad_enabled(), \
+                "Compiled models are only available for inference."
+            if compiled == 'trace':
+                # The trace is specific to the input shape (e.g. the unrolled time steps of the sLSTM), 
+                # which is fine, as every shape gets its own trace.
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', category=torch.jit.TracerWarning)
+                    warnings.simplefilter('ignore', category=FutureWarning)
+                    compiled_model = torch.jit.trace(self.my_model, x, check_trace=False)
+            elif compiled == 'compile':
+                compiled_model = torch.compile(self.my_model, dynamic=False)
+            else:
+                raise ValueError(f"Unexpected 'compiled' parameter received: {compiled}")
+            self.compiled_models[key] = compiled_model
+
+        return self.compiled_models[key]
+
     def train_model(self,
                     X_train,
                     Y_train,
@@ -55,11 +114,36 @@ class Model():
                     Y_dev = torch.Tensor([]),
                     pretrain_now = False,
                     finetune_now = True,
+                    pretrained_weights = None,
                     epochs=100,
                     set_learning_rates=[0.01, 0.005, 0.001, 0.0005],
                     batch_size=256,
-                    verbose=0):
+                    verbose=0,
+                    patience=None,
+                    eval_every=1,
+                    time_budget=None,
+                    profile_window=None,
+                    profile_trace_path=None,
+                    precision='fp32',
+                    train_indices=None,
+                    dev_indices=None):
         
+        # If 'train_indices' (or 'dev_indices') are given, X_train and Y_train (or X_dev and Y_dev) are 
+        # the backing tensors of all sets and only the samples with the given indices are used. 
+        # The batches are then gathered one by one, instead of gathering the whole set upfront.
+        # With 'pretrain_now', the model is trained on the standard load profile: The pytorch models train 
+        # as usual (the caller stores the weights, e.g. in the PretrainedWeightsStore), while the 
+        # parameter-free models have nothing to pretrain and return directly.
+        # For finetuning, the given pretrained weights (a state_dict, e.g. from the PretrainedWeightsStore) 
+        # are loaded first. 
+        # Optional early stopping: The dev loss is evaluated every 'eval_every' epochs and the training
+        # stops after 'patience' evaluations without improvement. At the end, the weights with the best 
+        # dev loss are restored. The training also stops, when the 'time_budget' (in seconds) is used up.
+        # The cost of the training is recorded in history['telemetry'] and the epochs of the optional 
+        # 'profile_window' = (first_epoch, nr_of_epochs) are traced with torch.profiler to the 'profile_trace_path'
+        # (per default a file per model type and process).
+        # With precision='bf16', the forward passes run with bfloat16 autocast (see forward_with_precision).
+        #
         if self.my_model.isPytorchModel == False:   # Simple, parameter free models    
             
             history = {}
@@ -68,54 +152,81 @@ class Model():
                 # No pretraining possible for these parameter-free models
                 pass    
             else:
+                if train_indices is not None:
+                    X_train, Y_train = X_train[train_indices], Y_train[train_indices]
                 self.my_model.train_model(X_train, Y_train)
         
         else:   # Pytorch models            
             
+            # The ModelAdapter already provides float32 tensors, so this is usually no copy.
+            X_train, Y_train = X_train.float(), Y_train.float()
+
             # Prepare Optimization
-            train_dataset = SequenceDataset(X_train, Y_train)
-            train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)            
+            train_loader = TensorBatchIterator(X_train, Y_train, batch_size=batch_size, shuffle=True, 
+                                               indices=train_indices)
             my_optimizer = optim.Adam(self.my_model.parameters(), lr=set_learning_rates[0])
             lr_scheduler = CustomLRScheduler(my_optimizer, set_learning_rates, epochs)
             history = {"loss": []}
             
             # Load pretrained weights
             if finetune_now:
-                pretrained_weights_path = f'scripts/outputs/pretrained_weights_{self.my_model.__class__.__name__}.pth'
-                self.my_model.load_state_dict(torch.load(pretrained_weights_path))
+                assert pretrained_weights is not None, "No pretrained weights given for finetuning."
+                self.my_model.load_state_dict(pretrained_weights)
+
+            # The dev batches are views on the dev set (or gathered per evaluation)
+            dev_batches = TensorBatchIterator(X_dev.float(), Y_dev.float(), batch_size=batch_size, 
+                                              indices=dev_indices)
+            has_dev_set = dev_batches.get_nr_of_samples() > 0
+            early_stopping = patience is not None and has_dev_set
+            if early_stopping:
+                history['dev_loss'] = []
+                best_dev_loss = float('inf')
+                best_state_dict = None
+                evaluations_without_improvement = 0
+            start_time = time.perf_counter()
+            if profile_trace_path is None:
+                profile_trace_path = f'scripts/outputs/profiler_trace_{self.my_model.__class__.__name__}_{os.getpid()}.json'
+            telemetry = TrainingTelemetry(profile_window, profile_trace_path)
 
             # Start training
             self.my_model.train()   # Switch on the training flags
+            my_optimizer.zero_grad()
             for epoch in range(epochs):
-                loss_sum = 0
+                loss_sum = torch.zeros(())     # Accumulated on the tensor, to avoid a sync per batch
                 total_samples = 0
-                batch_losses = []
                 
                 # Optimize over one epoch
+                telemetry.start_epoch(epoch)
                 for batch_x, batch_y in train_loader:
-                    my_optimizer.zero_grad()
-                    output = self.my_model(batch_x.float())
-                    loss = self.loss_fn(output, batch_y.float())
-                    batch_losses.append(loss.item())
+                    telemetry.measure('data_time')
+                    output = self.forward_with_precision(batch_x, precision)
+                    loss = self.loss_fn(output, batch_y)
+                    telemetry.measure('forward_time')
                     loss.backward()
+                    telemetry.measure('backward_time')
                     my_optimizer.step()
-                    loss_sum += loss.item() * batch_x.size(0)
+                    my_optimizer.zero_grad()
+                    telemetry.measure('optimizer_time')
+                    loss_sum += loss.detach() * batch_x.size(0)
                     total_samples += batch_x.size(0)
+                telemetry.end_epoch(epoch, total_samples)
                 
                 # Adjust learning rate once per epoch
                 lr_scheduler.adjust_learning_rate(epoch)
                 
                 # Calculate average loss for the epoch
-                epoch_loss = loss_sum / total_samples
+                epoch_loss = float(loss_sum) / total_samples
                 history['loss'].append(epoch_loss)
                 
+                # Evaluate the dev loss
+                is_eval_epoch = (epoch + 1) % eval_every == 0 or epoch + 1 == epochs
+                if has_dev_set and (verbose > 0 or (early_stopping and is_eval_epoch)):
+                    dev_loss = self.get_loss(dev_batches, precision)
+                    self.my_model.train()  # Switch back to training mode after evaluation
+                else:
+                    dev_loss = -1.0
+
                 if verbose > 0:
-                    if X_dev.shape[0] == 0 or Y_dev.shape[0] == 0:
-                        dev_loss = -1.0
-                    else:
-                        eval_value = self.evaluate(X_dev, Y_dev)
-                        dev_loss = float(eval_value['test_loss'][-1])
-                        self.my_model.train()  # Switch back to training mode after evaluation
                     print(f"Epoch {epoch + 1}/{epochs} - " + 
                         f"Loss = {epoch_loss:.4f} - " + 
                         f"Dev_Loss = {dev_loss:.4f} - " + 
@@ -123,14 +234,45 @@ class Model():
                         flush=True)
                 else:
                     print(".", end="", flush=True)
-                
-            # Save the trained weights
-            if pretrain_now:
-                pretrained_weights_path = f'scripts/outputs/pretrained_weights_{self.my_model.__class__.__name__}.pth'
-                torch.save(self.my_model.state_dict(), pretrained_weights_path)
+
+                # Keep the best weights and stop, if the dev loss doesn't improve anymore
+                if early_stopping and is_eval_epoch:
+                    history['dev_loss'].append(dev_loss)
+                    if dev_loss < best_dev_loss:
+                        best_dev_loss = dev_loss
+                        best_state_dict = copy.deepcopy(self.my_model.state_dict())
+                        history['best_epoch'] = epoch + 1
+                        evaluations_without_improvement = 0
+                    else:
+                        evaluations_without_improvement += 1
+                        if evaluations_without_improvement >= patience:
+                            break
+
+                # Stop, if the time budget is used up
+                if time_budget is not None and time.perf_counter() - start_time > time_budget:
+                    break
+
+            history['epochs'] = epoch + 1 if epochs > 0 else 0
+            history['telemetry'] = telemetry.get_records()
+            if early_stopping and best_state_dict is not None:
+                self.my_model.load_state_dict(best_state_dict)
 
         return history
     
+    # Return the mean loss of the model over the given batches (in evaluation mode).
+    #
+    def get_loss(self, batches, precision='fp32'):
+
+        self.my_model.eval()
+        loss_sum = 0.0
+        total_samples = 0
+        with torch.no_grad():
+            for batch_x, batch_y in batches:
+                loss_sum += self.loss_fn(self.forward_with_precision(batch_x, precision), batch_y) * batch_x.size(0)
+                total_samples += batch_x.size(0)
+
+        return float(loss_sum) / total_samples
+
     # Compute the Symmetric Mean Absolute Percentage Error (sMAPE).
     #
     def smape(self, y_true, y_pred, dim=None):
@@ -140,12 +282,12 @@ class Model():
         smape_values = torch.mean(numerator / (denominator + eps), dim=dim) * 2 * 100
         return smape_values
 
-    def evaluate(self, X_test, Y_test, results={}, deNormalize=False, batch_size=256):
+    def evaluate(self, X_test, Y_test, results={}, deNormalize=False, batch_size=256, dates=None, precision='fp32'):
         
         if self.my_model.isPytorchModel == False:   # Simple, parameter free models    
             
             # Predict
-            output = self.predict(X_test)
+            output = self.predict(X_test, dates=dates)
             assert output.shape == Y_test.shape, \
                 f"Shape mismatch: got {output.shape}, expected {Y_test.shape})"
             
@@ -170,30 +312,33 @@ class Model():
             smape_sum = 0
             total_samples = 0
         
+            # The ModelAdapter already provides float32 tensors, so this is usually no copy.
+            X_test, Y_test = X_test.float(), Y_test.float()
+
             # Unnormalize the target variable, if wished.
             if deNormalize == True:
                 assert self.modelAdapter != None, "No modelAdapter given."
-                Y_test = self.modelAdapter.deNormalizeY(Y_test)
+                deNormalization = OutputDeNormalization(self.modelAdapter.meanY, self.modelAdapter.stdY)
+                Y_test = deNormalization(Y_test)
             
-            # Create DataLoader
-            val_dataset = SequenceDataset(X_test, Y_test)
-            val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+            # Iterate over the batches (as views on the test data)
+            val_loader = TensorBatchIterator(X_test, Y_test, batch_size=batch_size, shuffle=False)
 
             self.my_model.eval()       # Switch off the training flags
             with torch.no_grad():  # No gradient calculation
                 for batch_x, batch_y in val_loader:
 
                     # Predict
-                    output = self.my_model(batch_x.float())
+                    output = self.forward_with_precision(batch_x, precision)
                     
                     # Unnormalize the target variable, if wished.
                     if deNormalize == True:
-                        output = self.modelAdapter.deNormalizeY(output)
+                        output = deNormalization(output)
                     
                     # Compute Metrics
-                    loss = self.loss_fn(output, batch_y.float())
+                    loss = self.loss_fn(output, batch_y)
                     loss_sum += loss.item() * batch_x.size(0)
-                    smape_val = self.smape(batch_y.float(), output)
+                    smape_val = self.smape(batch_y, output)
                     smape_sum += smape_val * batch_x.size(0)
                     total_samples += batch_x.size(0)
 
@@ -211,6 +356,81 @@ class Model():
         
         return results
     
+    # Return a torch module, that predicts the power (in watts) from the raw (not normalized) features.
+    # The normalization statistics of the modelAdapter are folded into frozen buffers of the module
+    # and the trained weights are shared with this model.
+    #
+    def get_normalized_model(self):
+
+        assert self.my_model.isPytorchModel == True, "Only available for pytorch models."
+        assert self.modelAdapter != None, "No modelAdapter given."
+
+        return NormalizedModel(self.my_model, self.modelAdapter)
+
+    # Export the model to an ONNX file, which can be served by the OnnxPredictor (without torch).
+    # If a modelAdapter is given, the normalization statistics are part of the graph (i.e. raw features 
+    # in, watts out). Otherwise, the graph has the same (normalized) input and output as predict.
+    # The number of days (batch dimension) is dynamic, the timesteps are fixed.
+    # With check_parity, the onnxruntime output is compared with the torch output.
+    # The TorchScript-based exporter is used (tested with pytorch 2.2 to 2.14).
+    #
+    def export_onnx(self, path, timesteps=24, opset_version=17, check_parity=True):
+
+        assert self.my_model.isPytorchModel == True, "Only available for pytorch models."
+
+        if self.modelAdapter is not None:
+            export_model = self.get_normalized_model()
+            meanX, stdX = torch.as_tensor(self.modelAdapter.meanX), torch.as_tensor(self.modelAdapter.stdX)
+        else:
+            export_model = self.my_model
+            meanX, stdX = 0.0, 1.0
+        example_input = (torch.randn(2, timesteps, self.num_of_features) * stdX + meanX).float()
+
+        # The fused transformer encoder (fast path) has no ONNX equivalent, so it is switched off for the export.
+        # The xLSTM computes the number of groups of its group norm from the input shape, which the default 
+        # ONNX export of group_norm doesn't support.
+        export_model.eval()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Newer pytorch versions (>= 2.5) have a dynamo-based exporter, which has to be switched off.
+        export_options = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            export_options['dynamo'] = False
+        torch.onnx.register_custom_op_symbolic('::group_norm', group_norm_onnx_symbolic, opset_version)
+        try:
+            with torch.no_grad(), disabled_transformer_fastpath(), warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=torch.jit.TracerWarning)
+                torch.onnx.export(export_model, (example_input,), path, 
+                                  input_names=['X'], output_names=['Y'], 
+                                  dynamic_axes={'X': {0: 'days'}, 'Y': {0: 'days'}},
+                                  opset_version=opset_version, **export_options)
+        finally:
+            torch.onnx.unregister_custom_op_symbolic('::group_norm', opset_version)
+
+        if check_parity:
+            import scripts.OnnxPredictor as OnnxPredictor
+            check_input = torch.cat([example_input, example_input[:1] * 0.5])     # Other batch size than exported
+            with torch.no_grad():
+                expected = export_model(check_input).numpy()
+            received = OnnxPredictor.OnnxPredictor(path).predict(check_input.numpy())
+            np.testing.assert_allclose(received, expected, rtol=1e-4, atol=1e-4 * float(np.abs(expected).max()),
+                                       err_msg=f"ONNX export of {self.my_model.__class__.__name__} differs from torch.")
+
+        return path
+
+    # Return an inference copy of this model with dynamically quantized weights (int8 by default).
+    # The weights of the LSTM and Linear layers are stored quantized and the activations are quantized
+    # on the fly, i.e. no calibration data is needed. The copy can't be trained any further.
+    #
+    def quantize(self, dtype=torch.qint8):
+
+        assert self.my_model.isPytorchModel == True, "Only available for pytorch models."
+
+        quantized_model = copy.copy(self)
+        quantized_model.my_model = quantize_dynamic_module(self.my_model, dtype)
+        quantized_model.compiled_models = {}
+
+        return quantized_model
+
     # Print the number of parameters of this model
     def get_nr_of_parameters(self, do_print=True):
         total_params = sum(p.numel() for p in self.my_model.parameters())
@@ -225,6 +445,7 @@ class xLSTM(nn.Module):
     def __init__(self, model_size, num_of_features, modelAdapter):
         super(xLSTM, self).__init__()
         self.isPytorchModel = True
+        self.supportsVmap = False   # The xlstm blocks use in-place operations
         self.forecast_horizon = 24
         
         # The following xLSTM config variables are as as provided by NX-AI.
@@ -311,6 +532,8 @@ class LSTM(nn.Module):
     def __init__(self, model_size, num_of_features, modelAdapter):
         super(LSTM, self).__init__()
         self.isPytorchModel = True
+        self.supportsVmap = True
+        self.vmapped = False        # Use the unfused LSTM layers, which are supported by vmap
         self.forecast_horizon = 24
         
         # Fixed dense, for better comparison
@@ -353,8 +576,12 @@ class LSTM(nn.Module):
         self.output_layer = nn.Linear(hidden_dimension_dense2, 1)          
         
     def forward(self, x):
-        x, _ = self.lstm1(x)
-        x, _ = self.lstm2(x)
+        if self.vmapped:
+            x = unfused_lstm(self.lstm1, x)
+            x = unfused_lstm(self.lstm2, x)
+        else:
+            x, _ = self.lstm1(x)
+            x, _ = self.lstm2(x)
         x = self.activation(self.dense1(x))
         x = self.activation(self.dense2(x))
         x = self.output_layer(x)
@@ -365,6 +592,8 @@ class Transformer(nn.Module):
     def __init__(self, model_size, num_of_features, modelAdapter):
         super(Transformer, self).__init__()
         self.isPytorchModel = True
+        self.supportsVmap = True
+        self.quantized = False      # The fused encoder (fast path) doesn't support quantized linear layers
         self.num_of_features = num_of_features
         self.forecast_horizon = 24
         
@@ -423,13 +652,121 @@ class Transformer(nn.Module):
 
     def forward(self, x):
         x = self.input_projection(x)
-        x = self.transformer(x)
+        if self.quantized:
+            with disabled_transformer_fastpath():
+                x = self.transformer(x)
+        else:
+            x = self.transformer(x)
         x = self.activation(self.dense1(x))
         x = self.activation(self.dense2(x))
         x = self.output_layer(x)
         return x
 
 
+# Return forward(x, precision) of the given models (e.g. all models of a vectorized forward pass) with the
+# given precision. For 'bf16', the forward pass runs with CPU autocast and falls back to fp32, if the
+# models don't support it. In that case, all given models are marked, so the fallback is only reported once.
+#
+def forward_with_autocast(forward, x, precision, myModels):
+
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError(f"Unexpected 'precision' parameter received: {precision}")
+
+    if precision == 'bf16' and all(myModel.bf16_supported for myModel in myModels):
+        try:
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                return forward(x, 'bf16').float()
+        except RuntimeError as error:
+            print(f"WARNING: {myModels[0].my_model.__class__.__name__} doesn't support bf16 autocast ({error}). "
+                  "Falling back to fp32.", flush=True)
+            for myModel in myModels:
+                myModel.bf16_supported = False
+
+    return forward(x, 'fp32')
+
+
+# Run the given (single layer, batch_first and bidirectional) LSTM step by step with elementary operations.
+# This is equivalent to nn.LSTM, but also works within torch.func.vmap (which doesn't support aten::lstm).
+#
+def unfused_lstm(lstm, x):
+
+    outputs = []
+    for suffix, reverse in (('_l0', False), ('_l0_reverse', True)):
+        weight_hh = getattr(lstm, 'weight_hh' + suffix)
+        bias_hh = getattr(lstm, 'bias_hh' + suffix)
+        x_projected = F.linear(x, getattr(lstm, 'weight_ih' + suffix), getattr(lstm, 'bias_ih' + suffix))
+
+        h = x.new_zeros(x.shape[0], lstm.hidden_size)
+        c = x.new_zeros(x.shape[0], lstm.hidden_size)
+        hidden_states = []
+        timesteps = range(x.shape[1] - 1, -1, -1) if reverse else range(x.shape[1])
+        for t in timesteps:
+            gates = x_projected[:, t] + F.linear(h, weight_hh, bias_hh)
+            input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=-1)
+            c = torch.sigmoid(forget_gate) * c + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+            h = torch.sigmoid(output_gate) * torch.tanh(c)
+            hidden_states.append(h)
+        if reverse:
+            hidden_states.reverse()
+        outputs.append(torch.stack(hidden_states, dim=1))
+
+    return torch.cat(outputs, dim=-1)
+
+
+# Return a copy of the given pytorch model with dynamically quantized LSTM and Linear layers.
+#
+def quantize_dynamic_module(my_model, dtype=torch.qint8):
+
+    quantized_model = torch.ao.quantization.quantize_dynamic(copy.deepcopy(my_model).eval(), 
+                                                             {nn.LSTM, nn.Linear}, dtype=dtype)
+    quantized_model.quantized = True
+
+    return quantized_model
+
+
+# Switch off the fused transformer encoder of pytorch (fast path) within this context.
+#
+@contextlib.contextmanager
+def disabled_transformer_fastpath():
+
+    fastpath_enabled = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        yield
+    finally:
+        torch.backends.mha.set_fastpath_enabled(fastpath_enabled)
+
+
+# ONNX export of F.group_norm, which also supports a traced (i.e. non-constant) number of groups.
+# The groups are normalized after reshaping the input to (N, num_groups, -1), as in pytorch.
+# Only the public graph API (g.op and the node of a value) is used, no private helpers of torch.onnx.
+#
+def group_norm_onnx_symbolic(g, input, num_groups, weight, bias, eps, cudnn_enabled):
+
+    def constant(value):
+        return g.op('Constant', value_t=torch.tensor(value))
+
+    input_shape = g.op('Shape', input)
+    batch_shape = g.op('Slice', input_shape, constant([0]), constant([1]))
+    group_shape = g.op('Concat', batch_shape, g.op('Reshape', num_groups, constant([1])), constant([-1]), axis_i=0)
+    x = g.op('Reshape', input, group_shape)
+    x = g.op('Sub', x, g.op('ReduceMean', x, axes_i=[2], keepdims_i=1))
+    var = g.op('ReduceMean', g.op('Mul', x, x), axes_i=[2], keepdims_i=1)
+    eps = g.op('Cast', eps, to_i=1)     # The scalar eps is a double constant, the input float
+    x = g.op('Div', x, g.op('Sqrt', g.op('Add', var, eps)))
+
+    # Per channel affine transformation on the shape (N, C, -1), so the rank of the input isn't needed
+    channel_shape = g.op('Concat', g.op('Slice', input_shape, constant([0]), constant([2])), constant([-1]), axis_i=0)
+    x = g.op('Reshape', x, channel_shape)
+    if not weight.node().mustBeNone():
+        x = g.op('Mul', x, g.op('Reshape', weight, constant([-1, 1])))
+    if not bias.node().mustBeNone():
+        x = g.op('Add', x, g.op('Reshape', bias, constant([-1, 1])))
+    x = g.op('Reshape', x, input_shape)
+
+    return x
+
+
 class KNN():
     def __init__(self, model_size, num_of_features, modelAdapter):
         super(KNN, self).__init__()
@@ -440,14 +777,15 @@ class KNN():
     
     def train_model(self, X_train, Y_train):
 
-        # Store the training data as flattened tensors
-        self.X_train = X_train.view(X_train.shape[0], -1)  # Flatten X_train from (nr_of_batches, timesteps, features) to (nr_of_batches, timesteps * features)
+        # Store the training data as flattened tensors.
+        # The data is copied, so that the state_dict doesn't contain the whole (memory-mapped) dataset.
+        self.X_train = X_train.reshape(X_train.shape[0], -1).clone()  # Flatten X_train from (nr_of_batches, timesteps, features) to (nr_of_batches, timesteps * features)
         self.Y_train = Y_train  # Y_train remains unchanged in shape (nr_of_days, timesteps, 1)
     
     # Given an input x, find the closest neighbor from the training data X_train
     # and return the corresponding Y_train.
     #
-    def forward(self, x):
+    def forward(self, x, dates=None):
         
         batch_size = x.size(0)
         nr_of_timesteps = x.size(1)
@@ -479,39 +817,68 @@ class KNN():
 # Prediction with open-access synthetic load profiles.
 #
 class SyntheticLoadProfile():
-    def __init__(self, model_size, num_of_features, modelAdapter):
+    def __init__(self, model_size, num_of_features, modelAdapter, standardLoadProfile=None):
         super(SyntheticLoadProfile, self).__init__()
         self.isPytorchModel = False
 
-        # Load standard loadprofile
-        pretraining_filename = 'scripts/outputs/standard_loadprofile.pkl'
-        with open(pretraining_filename, 'rb') as f:
-            (_, Y_standardload, _) = pickle.load(f)
-            self.Y_standardload_test = Y_standardload['test']
+        # Without a standard load profile, the model has to be loaded with load_state_dict
+        self.Y_standardload = None
+        self.Y_standardload_test = None     # Only set by legacy state_dicts
+        if standardLoadProfile is not None:
+            (Y_standardload, standardAdapter) = standardLoadProfile
+            self.Y_standardload = Y_standardload['all'].clone()   # Detach from the memory-mapped file
+
+            # Row i of the standard profile is the day first_date + i * prediction_rate (in ns)
+            self.first_date = torch.tensor(standardAdapter.first_prediction_date.value)
+            self.prediction_rate = torch.tensor(standardAdapter.prediction_rate.value)
     
     def train_model(self, X_train, Y_train):
         pass
     
-    def forward(self, x):
+    def forward(self, x, dates=None):
         
-        # Predict the next days, using the standard profile.
-        # In this project the predicted testset has the same shape as standard-load-profile.
+        # Predict the given days with the standard profile of the same dates.
         #
-        nr_of_days = x.shape[0]
-        if nr_of_days == self.Y_standardload_test.shape[0]:
-            y_pred = self.Y_standardload_test
-        else:
-            y_pred = np.zeros(shape=(nr_of_days, *self.Y_standardload_test.shape[1:]))
+        if self.Y_standardload_test is not None:
+            # Legacy state_dict: The given days are the test set, whose standard profile was stored
+            if x.shape[0] != self.Y_standardload_test.shape[0]:
+                raise ValueError("A legacy SyntheticLoadProfile can only predict its test set.")
+            return self.Y_standardload_test
+        if dates is None:
+            raise ValueError("The SyntheticLoadProfile needs the dates of the predicted days.")
+        if self.Y_standardload is None:
+            raise ValueError("The SyntheticLoadProfile has no standard load profile.")
+        assert len(dates) == x.shape[0], f"Shape mismatch: got {len(dates)} dates for {x.shape[0]} days"
+
+        # Lookup the rows of the dates
+        offsets = pd.DatetimeIndex(dates).asi8 - int(self.first_date)
+        rows = offsets // int(self.prediction_rate)
+        if np.any(offsets % int(self.prediction_rate) != 0) or np.any(rows < 0) \
+                or np.any(rows >= self.Y_standardload.shape[0]):
+            raise ValueError("The standard load profile doesn't cover all given dates.")
+        y_pred = self.Y_standardload[torch.from_numpy(rows)]
         
         return y_pred
     
     def state_dict(self):
         state_dict = {}
-        state_dict['Y_standardload_test'] = self.Y_standardload_test
+        state_dict['Y_standardload'] = self.Y_standardload
+        state_dict['first_date'] = self.first_date
+        state_dict['prediction_rate'] = self.prediction_rate
         return state_dict
 
     def load_state_dict(self, state_dict):
-        self.Y_standardload_test = state_dict['Y_standardload_test']
+
+        # Results stored before the lookup by date only contain the standard profile of the test set
+        if 'Y_standardload_test' in state_dict:
+            self.Y_standardload = None
+            self.Y_standardload_test = torch.as_tensor(state_dict['Y_standardload_test'])
+            return
+
+        self.Y_standardload = state_dict['Y_standardload']
+        self.Y_standardload_test = None
+        self.first_date = state_dict['first_date']
+        self.prediction_rate = state_dict['prediction_rate']
 
 
 class PersistencePrediction():
@@ -520,24 +887,22 @@ class PersistencePrediction():
         self.isPytorchModel = False
         self.modelAdapter = modelAdapter
     
-    def forward(self, x):
+    def forward(self, x, dates=None):
         """
         Upcoming load profile = load profile 7 days ago.
         Assumption: The training load profile immediately precedes the given test load profile (to ensure accurate 
         prediction of the initial days in the test set).
         """
 
-        x = self.modelAdapter.deNormalizeX(x)    # de-normalize especially the lagged power feature
-
-        # Take the latest available lagged loads as predictions
+        # Take the latest available lagged loads as predictions.
+        # Only this column is de-normalized and normalized again (with the statistics of Y), 
+        # to compare it to other models.
         # 
-        lagged_load_feature = 11
-        y_pred = x[:,:, lagged_load_feature]
-        
-        # Add axis and normalize y_pred again, to compare it to other models.
-        #
-        y_pred = y_pred[:,:,np.newaxis]
-        y_pred = self.modelAdapter.normalizeY(y_pred)
+        lagged_load_feature = self.modelAdapter.getLaggedPowerFeatureIndex(pd.Timedelta(days=7))
+        lagged_load = x[:,:, lagged_load_feature:lagged_load_feature + 1]
+        lagged_load = lagged_load * float(self.modelAdapter.stdX[lagged_load_feature]) \
+                        + float(self.modelAdapter.meanX[lagged_load_feature])
+        y_pred = (lagged_load - torch.as_tensor(self.modelAdapter.meanY)) / torch.as_tensor(self.modelAdapter.stdY)
         assert y_pred.shape == (x.size(0), 24, 1), \
             f"Shape mismatch: got {y_pred.shape}, expected ({x.size(0)}, 24, 1)"
         
@@ -555,16 +920,262 @@ class PersistencePrediction():
         self.Y_train = state_dict['Y_train']
 
 
-class SequenceDataset(Dataset):
-    def __init__(self, X, Y):
+# Train one model of the same type and size per community, all in one training loop.
+#
+# The parameters of the N models are stacked and the forward pass of all communities is vectorized
+# with torch.func.vmap. Models without vmap support (or with vectorize=False) are run one after another
+# in each step (grouped), but still share the loop and the optimizer step. Adam works element-wise, 
+# so every community has its own weights, its own optimizer state and its own loss history, like 
+# with independent training.
+#
+class MultiCommunityModel():
+    def __init__(self, model_type, model_size, num_of_features, modelAdapters, vectorize=True, 
+                 standardLoadProfile=None):
+        
+        self.models = [Model(model_type, model_size, num_of_features, modelAdapter, standardLoadProfile) 
+                       for modelAdapter in modelAdapters]
+        self.isPytorchModel = self.models[0].my_model.isPytorchModel
+        self.vectorize = vectorize and self.isPytorchModel and self.models[0].my_model.supportsVmap
+        self.loss_fn = self.models[0].loss_fn
+
+    # Train all models with the data of their community, i.e. X_train has the shape
+    # (nr_of_communities, nr_of_batches, timesteps, features).
+    # Return one history per community.
+    #
+    def train_model(self,
+                    X_train,
+                    Y_train,
+                    finetune_now = True,
+                    pretrained_weights = None,
+                    epochs=100,
+                    set_learning_rates=[0.01, 0.005, 0.001, 0.0005],
+                    batch_size=256,
+                    time_budget=None,
+                    precision='fp32',
+                    ):
+        
+        # Like Model.train_model, the training stops when the 'time_budget' (in seconds) is used up and 
+        # with precision='bf16', the forward passes run with bfloat16 autocast.
+        #
+        assert X_train.shape[0] == len(self.models), \
+            f"Shape mismatch: got {X_train.shape[0]} communities, expected {len(self.models)}"
+
+        if self.isPytorchModel == False:    # Simple, parameter free models
+            return [myModel.train_model(X_train[i], Y_train[i], finetune_now=finetune_now) 
+                    for i, myModel in enumerate(self.models)]
+
+        # Load pretrained weights
+        X_train, Y_train = X_train.float(), Y_train.float()
+        my_models = [myModel.my_model for myModel in self.models]
+        if finetune_now:
+            assert pretrained_weights is not None, "No pretrained weights given for finetuning."
+            for my_model in my_models:
+                my_model.load_state_dict(pretrained_weights)
+
+        # Prepare Optimization
+        for my_model in my_models:
+            my_model.train()   # Switch on the training flags
+        if self.vectorize:
+            params, buffers = stack_module_state(my_models)
+            base_model = copy.deepcopy(my_models[0]).to('meta')
+            base_model.vmapped = True
+            def forward_one(params, buffers, x):
+                return functional_call(base_model, (params, buffers), (x,))
+            forward_all = vmap(forward_one, randomness='same')   # Same dropout masks, but for different models
+            forward = lambda batch_x: forward_with_autocast(lambda x, _: forward_all(params, buffers, x), 
+                                                            batch_x, precision, self.models)
+            trained_parameters = list(params.values())
+        else:
+            forward = lambda batch_x: torch.stack([myModel.forward_with_precision(batch_x[i], precision) 
+                                                   for i, myModel in enumerate(self.models)])
+            trained_parameters = [param for my_model in my_models for param in my_model.parameters()]
+        loss_all = vmap(self.loss_fn)
+        my_optimizer = optim.Adam(trained_parameters, lr=set_learning_rates[0])
+        lr_scheduler = CustomLRScheduler(my_optimizer, set_learning_rates, epochs)
+        histories = [{"loss": []} for _ in my_models]
+        start_time = time.perf_counter()
+
+        # Start training
+        nr_of_communities, nr_of_samples = X_train.shape[0], X_train.shape[1]
+        community_indices = torch.arange(nr_of_communities)[:, None]
+        for epoch in range(epochs):
+            loss_sums = torch.zeros(nr_of_communities)
+
+            # Optimize over one epoch, with an own shuffling per community
+            permutations = torch.stack([torch.randperm(nr_of_samples) for _ in range(nr_of_communities)])
+            for start in range(0, nr_of_samples, batch_size):
+                batch_indices = permutations[:, start:start + batch_size]
+                batch_x = X_train[community_indices, batch_indices]
+                batch_y = Y_train[community_indices, batch_indices]
+                my_optimizer.zero_grad()
+                output = forward(batch_x)
+                losses = loss_all(output, batch_y)
+                losses.sum().backward()     # The communities don't share any parameters
+                my_optimizer.step()
+                loss_sums += losses.detach() * batch_indices.shape[1]
+            
+            # Adjust learning rate once per epoch
+            lr_scheduler.adjust_learning_rate(epoch)
+
+            # Calculate average loss for the epoch
+            epoch_losses = [float(loss_sum) / nr_of_samples for loss_sum in loss_sums]     # Like Model.train_model
+            for history, epoch_loss in zip(histories, epoch_losses):
+                history['loss'].append(epoch_loss)
+            print(".", end="", flush=True)
+
+            # Stop, if the time budget is used up
+            if time_budget is not None and time.perf_counter() - start_time > time_budget:
+                break
+
+        # Write the trained weights back to the models of the communities
+        if self.vectorize:
+            for i, my_model in enumerate(my_models):
+                my_model.load_state_dict({name: value[i] for name, value in {**params, **buffers}.items()})
+
+        return histories
+
+
+# Z-normalize the raw input features with the (frozen) statistics of the ModelAdapter.
+#
+class InputNormalization(nn.Module):
+    def __init__(self, meanX, stdX):
+        super(InputNormalization, self).__init__()
+        self.register_buffer('meanX', torch.as_tensor(meanX, dtype=torch.float32))
+        self.register_buffer('stdX', torch.as_tensor(stdX, dtype=torch.float32))
+
+    def forward(self, x):
+        return (x - self.meanX) / self.stdX
+
+
+# Undo the normalization of the model output with the (frozen) statistics of the ModelAdapter.
+#
+class OutputDeNormalization(nn.Module):
+    def __init__(self, meanY, stdY):
+        super(OutputDeNormalization, self).__init__()
+        self.register_buffer('meanY', torch.as_tensor(meanY, dtype=torch.float32))
+        self.register_buffer('stdY', torch.as_tensor(stdY, dtype=torch.float32))
+
+    def forward(self, y):
+        return (y * self.stdY) + self.meanY
+
+
+# Pytorch model with the normalization inside the graph: raw features in, watts out.
+#
+class NormalizedModel(nn.Module):
+    def __init__(self, model, modelAdapter):
+        super(NormalizedModel, self).__init__()
+        self.isPytorchModel = True
+        self.input_normalization = InputNormalization(modelAdapter.meanX, modelAdapter.stdX)
+        self.model = model
+        self.output_denormalization = OutputDeNormalization(modelAdapter.meanY, modelAdapter.stdY)
+
+    def forward(self, x):
+        x = self.input_normalization(x)
+        x = self.model(x)
+        x = self.output_denormalization(x)
+        return x
+
+
+# Iterate over the batches of in-memory tensors.
+# Shuffling permutes the sample indices once per epoch and every batch is gathered with one
+# index_select (instead of one __getitem__ per sample and the collation of a DataLoader).
+# Without shuffling, the batches are views on the given tensors.
+#
+class TensorBatchIterator:
+    def __init__(self, X, Y, batch_size, shuffle=False, indices=None):
+        assert X.shape[0] == Y.shape[0], f"Shape mismatch: got {X.shape[0]} inputs and {Y.shape[0]} targets"
         self.X = X
         self.Y = Y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        # Optionally, X and Y are the backing tensors of several sets and only the samples with 
+        # the given indices are iterated. Each batch is then gathered on its own.
+        self.indices = None if indices is None else torch.as_tensor(indices, dtype=torch.long)
 
     def __len__(self):
-        return len(self.X)
+        return -(-self.get_nr_of_samples() // self.batch_size)    # Round up
+
+    def get_nr_of_samples(self):
+        return self.X.shape[0] if self.indices is None else len(self.indices)
+
+    def __iter__(self):
+
+        nr_of_samples = self.get_nr_of_samples()
+        if self.shuffle or self.indices is not None:
+            indices = torch.randperm(nr_of_samples) if self.shuffle else torch.arange(nr_of_samples)
+            if self.indices is not None:
+                indices = self.indices[indices]
+            for start in range(0, nr_of_samples, self.batch_size):
+                batch_indices = indices[start:start + self.batch_size]
+                yield self.X.index_select(0, batch_indices), self.Y.index_select(0, batch_indices)
+        else:
+            for start in range(0, nr_of_samples, self.batch_size):
+                yield self.X[start:start + self.batch_size], self.Y[start:start + self.batch_size]
+
+
+# Record the cost of the training per epoch: the wall time, the throughput, the time split into
+# data loading, forward, backward and optimizer step, and the peak memory (RSS) of the process.
+# Optionally, a window of epochs is traced with torch.profiler (exported as chrome trace).
+#
+class TrainingTelemetry:
+    phases = ('data_time', 'forward_time', 'backward_time', 'optimizer_time')
+
+    def __init__(self, profile_window=None, trace_path=None):
+        self.records = {name: [] for name in ('epoch_time', 'samples_per_sec', *self.phases, 'peak_rss_mb')}
+        self.profile_window = profile_window
+        self.trace_path = trace_path
+        self.profiler = None
+
+    def start_epoch(self, epoch):
+
+        if self.profile_window is not None and epoch == self.profile_window[0]:
+            self.profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+            self.profiler.start()
+
+        self.phase_times = dict.fromkeys(self.phases, 0.0)
+        self.epoch_start_time = self.last_time = time.perf_counter()
+
+    # Add the time since the last measurement to the given phase.
+    #
+    def measure(self, phase):
+        now = time.perf_counter()
+        self.phase_times[phase] += now - self.last_time
+        self.last_time = now
+
+    def end_epoch(self, epoch, nr_of_samples):
+
+        epoch_time = time.perf_counter() - self.epoch_start_time
+        self.records['epoch_time'].append(epoch_time)
+        self.records['samples_per_sec'].append(nr_of_samples / epoch_time if epoch_time > 0 else 0.0)
+        for phase, phase_time in self.phase_times.items():
+            self.records[phase].append(phase_time)
+        self.records['peak_rss_mb'].append(self.get_peak_rss_mb())
+
+        if self.profiler is not None and epoch + 1 == self.profile_window[0] + self.profile_window[1]:
+            self.stop_profiler()
+
+    # Return the records (json serializable).
+    #
+    def get_records(self):
+
+        if self.profiler is not None:   # The training stopped within the profile window
+            self.stop_profiler()
+
+        return self.records
+
+    def stop_profiler(self):
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(self.trace_path)
+        self.records['profiler_trace'] = self.trace_path
+        self.profiler = None
 
-    def __getitem__(self, idx):
-        return self.X[idx], self.Y[idx]
+    @staticmethod
+    def get_peak_rss_mb():
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return peak_rss / 1024**2    # Bytes on macOS
+        return peak_rss / 1024           # Kilobytes on Linux
 
 
 class CustomLRScheduler:
@@ -1,7 +1,9 @@
 import pandas as pd
 import numpy as np
 import datetime
+import copy
 import torch
+from collections.abc import Mapping
 
 # Bring the data into the data format needed by the model
 #
@@ -19,6 +21,9 @@ class ModelAdapter:
                  sampling_time = pd.Timedelta(hours=1, minutes=0),
                  prediction_rate = pd.Timedelta(days=1),
                  prediction_horizon = pd.Timedelta(days=0, hours=23, minutes=0),
+                 calendarCache=None,
+                 laggedPowerOffsets = (pd.Timedelta(days=7), pd.Timedelta(days=14), pd.Timedelta(days=21)),
+                 dtype = np.float32,
                  ):
 
         self.prediction_rate = prediction_rate
@@ -31,12 +36,47 @@ class ModelAdapter:
         self.testSize = testSize
         self.devSize = devSize
         self.trainFuture = trainFuture
-        self.nr_of_lagged_days = 3
+        self.dtype = dtype      # Floating point type of all features, targets and normalization statistics
+        self.statistics_chunk_size = 64     # Number of samples per block, when producing the features and statistics
+        self.laggedPowerOffsets = tuple(laggedPowerOffsets)
+        self.nr_of_lagged_days = len(self.laggedPowerOffsets)
+
+        # The calendar features can be shared between several model adapters
+        if calendarCache is None:
+            calendarCache = CalendarFeatureCache()
+        self.calendarCache = calendarCache
 
         # Optionally: Fix the random-seed for reproducibility
         if seed != None:
             np.random.seed(seed)
 
+    # Return all parameters, that affect the transformed data (except the data split sizes).
+    #
+    def getPreprocessingParameters(self):
+
+        parameters = {
+            'sampling_time': self.sampling_time,
+            'prediction_rate': self.prediction_rate,
+            'prediction_horizon': self.prediction_horizon,
+            'addLaggedPower': self.addLaggedPower,
+            'laggedPowerOffsets': self.laggedPowerOffsets,
+            'shuffle_data': self.shuffle_data,
+            'dtype': np.dtype(self.dtype).name,
+        }
+        return parameters
+
+    # Don't persist the (shared) calendar cache together with the model adapter.
+    #
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['calendarCache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.calendarCache is None:
+            self.calendarCache = CalendarFeatureCache()
+
     def transformData(self, 
                       powerProfiles, 
                       weatherData, 
@@ -50,17 +90,27 @@ class ModelAdapter:
         self.first_prediction_date = self.getFirstPredictionTimestamp(powerProfiles, first_prediction_clocktime)
         self.last_available_datetime = powerProfiles.index[-1]
 
-        # Convert the power timeseries to a nd-array with format (nr_of_batches, timesteps, outputs)
+        # Convert the power timeseries to a nd-array with format (nr_of_batches, timesteps, outputs).
+        # If a DataFrame with one profile per column (i.e. per community) is given, all profiles 
+        # are transformed at once and the format is (nr_of_communities, nr_of_batches, timesteps, outputs).
         Y_all = self.formattingY(powerProfiles)
 
+        # Split up the samples into train, dev and test set. The sets are only indices on the
+        # shared data, so they are known before the input features are produced.
+        split_indices = self.splitUpSamples(Y_all.shape[-3])
+
         # Convert the input features to a nd-array with format (nr_of_batches, timesteps, features)
-        X_all = self.formattingX(weatherData, powerProfiles)
+        # or (nr_of_communities, nr_of_batches, timesteps, features), respectively.
+        # The normalization statistics of X are fed with the train samples of every produced block.
+        statisticsX = self.createStatistics(Y_all)      # Y_all has the same axes as X_all
+        X_all = self.formattingX(weatherData, powerProfiles, statisticsX, split_indices['train'])
 
-        # Split up the data into train, dev, test and modeldata
-        X_all, Y_all = self.splitUpData(X_all, Y_all)
+        # All sets are represented by indices on the shared X_all and Y_all (no copy)
+        X_all = DatasetSplits(X_all, split_indices)
+        Y_all = DatasetSplits(Y_all, split_indices)
 
         # Normalize all input data and target value
-        X_all, Y_all = self.normalizeAll(X_all, Y_all)
+        X_all, Y_all = self.normalizeAll(X_all, Y_all, statisticsX)
         
         # Convert from ndarray to torch tensor
         X_all, Y_all = self.convertToTorchTensor(X_all, Y_all)
@@ -70,7 +120,7 @@ class ModelAdapter:
     def getFirstPredictionTimestamp(self, powerProfiles, first_prediction_clocktime):
 
         # Calculate the first possible prediction timestamp
-        first_timestamp = powerProfiles.index[0] + pd.Timedelta(days=7*(self.nr_of_lagged_days))
+        first_timestamp = powerProfiles.index[0] + max(self.laggedPowerOffsets, default=pd.Timedelta(0))
 
         # Choose a prediction datetime, which is on the same day as the 'first_timestamp'.
         target_timestamp = pd.Timestamp.combine(first_timestamp.date(), first_prediction_clocktime) \
@@ -86,149 +136,212 @@ class ModelAdapter:
 
     # Convert the input data to the model format.
     # For more informations regarding the shape see model design for this project.
+    # The features are produced in blocks of samples. Optionally, the given statistics are fed with 
+    # the samples of each block, that are contained in 'statistics_indices' (e.g. the train set).
     #
-    def formattingX(self, weatherData, powerProfiles=None):
-
-        batch_id = 0
-        next_prediction_date = self.first_prediction_date
+    def formattingX(self, weatherData, powerProfiles=None, statistics=None, statistics_indices=None):
 
         # Calculate/define the number of features of X
         nr_of_features = 11
         if self.addLaggedPower == True:
-            nr_of_features += 3
+            nr_of_features += self.nr_of_lagged_days
         if weatherData is None:
             num_of_weather_features = 6 # Default weather features
         else:
             num_of_weather_features = weatherData.shape[1]
         nr_of_features += num_of_weather_features
 
-        seq_start_time = self.first_prediction_date
-        seq_end_time = self.first_prediction_date + self.prediction_horizon
-        nr_of_timesteps = len(pd.date_range(start=seq_start_time, end=seq_end_time, freq=self.sampling_time))
-        X_all = np.zeros(shape=(0, nr_of_timesteps, nr_of_features))
+        # Get the positions of all timesteps of all batches on one regular time grid,
+        # starting at the first prediction date. The shape is (nr_of_batches, timesteps).
+        positions = self.getBatchPositions()
+        nr_of_batches, nr_of_timesteps = positions.shape
+        nr_of_communities = self.getCommunityShape(powerProfiles)
+        X_all = np.zeros(shape=(*nr_of_communities, nr_of_batches, nr_of_timesteps, nr_of_features), dtype=self.dtype)
+        time_grid = pd.date_range(start=self.first_prediction_date, periods=positions.max(initial=-1) + 1, 
+                                  freq=self.sampling_time)
+
+        # The weekday one-hot encoding (7 features) and the cyclical clock time and day-of-year 
+        # features (4 features) only depend on the time grid and the public holidays and are 
+        # therefore shared by all profiles.
+        calendar_features = self.calendarCache.getFeatures(time_grid, self.public_holidays)
+
+        # Optionally: Get the lagged profiles (per default one, two and three weeks ago).
+        # The (regularly sampled) profile is shifted by an integer offset and then cut into 
+        # a strided view per batch, so each lag column is copied only once.
+        lagged_windows = []
+        if self.addLaggedPower == True:
+            power_values = np.asarray(powerProfiles.values)
+            grid_offset = self.getGridOffset(powerProfiles.index[0])
+            for lagged_offset in self.laggedPowerOffsets:
+                lag = lagged_offset // self.sampling_time
+                assert lag * self.sampling_time == lagged_offset, \
+                    "The lagged power offsets must be multiples of the 'sampling_time'."
+                assert 0 <= grid_offset - lag, "Not enough history available for the lagged power offsets."
+                lagged_windows.append(self.getSlidingWindows(power_values[grid_offset - lag:]))
+
+        # If available: Get the rows of the past weather measurements.
+        # Each batch gets the weather slice [prediction_date - prediction_horizon, prediction_date].
+        # Shorter slices (i.e. missing measurements) are written to the first timesteps.
+        if weatherData is not None:
+            prediction_dates = time_grid[positions[:, 0]]
+            slice_start = weatherData.index.searchsorted(prediction_dates - self.prediction_horizon, side='left')
+            slice_end = weatherData.index.searchsorted(prediction_dates, side='right')
+            weather_rows = slice_start[:, np.newaxis] + np.arange(nr_of_timesteps)
+            is_weather_available = weather_rows < slice_end[:, np.newaxis]
+            weather_values = np.asarray(weatherData.values, dtype=X_all.dtype)
+
+        is_statistics_sample = np.zeros(nr_of_batches, dtype=bool)
+        if statistics is not None:
+            is_statistics_sample[statistics_indices] = True
+
+        # Fill X block by block, so the statistics are estimated while the block is still in the cache
+        for start in range(0, nr_of_batches, self.statistics_chunk_size):
+            end = min(start + self.statistics_chunk_size, nr_of_batches)
+            X_block = X_all[..., start:end, :, :]
+
+            index = CalendarFeatureCache.nr_of_features
+            X_block[..., :index] = calendar_features[positions[start:end]]
+
+            for windows in lagged_windows:
+                X_block[..., index] = windows[..., start:end, :]
+                index += 1
+
+            if weatherData is not None:
+                rows = weather_rows[start:end]
+                is_available = is_weather_available[start:end]
+                X_block[..., index:index + num_of_weather_features] = \
+                    np.where(is_available[:, :, np.newaxis], weather_values[np.where(is_available, rows, 0)], 0.0)
+            # Otherwise, the weather features are left at zero
+
+            if statistics is not None:
+                block_mask = is_statistics_sample[start:end]
+                if np.all(block_mask):
+                    statistics.update(X_block)
+                elif np.any(block_mask):
+                    statistics.update(X_block[..., block_mask, :, :])
 
-        while next_prediction_date + self.prediction_horizon <= self.last_available_datetime:
+        return X_all
 
-            # Add a new batch to the X array
-            new_values = np.zeros(shape=(1, nr_of_timesteps, nr_of_features))
-            X_all = np.concatenate((X_all, new_values), axis=0)
+    # Return the index of the lagged power feature with the given offset (e.g. 7 days).
+    #
+    def getLaggedPowerFeatureIndex(self, lagged_offset):
 
-            # Define the current time range
-            end_of_prediction = next_prediction_date + self.prediction_horizon
-            total_input_range = pd.date_range(start=next_prediction_date, end=end_of_prediction, freq=self.sampling_time)
+        assert self.addLaggedPower == True, "The model adapter doesn't add lagged power features."
+        assert lagged_offset in self.laggedPowerOffsets, \
+            f"No lagged power feature with an offset of {lagged_offset} available."
 
-            # Get the current weekday indices [0 ... 6] of all nr_of_timesteps.
-            # The shape of the following variable is (nr_of_timesteps, 1).
-            weekday_numbers = total_input_range.weekday.values
-            
-            # Identify public holidays and replace that day with Sunday
-            public_holiday_indices = total_input_range.floor("D").isin(self.public_holidays)
-            weekday_numbers[public_holiday_indices] = 6
-
-            # Create a one-hot encoding array with shape (nr_of_timesteps, 7).
-            one_hot_encoding = np.eye(7)[weekday_numbers]
-            index = 7
-            X_all[batch_id, :, :index] = one_hot_encoding
-
-            # Convert clock_time to cyclical features
-            hour_sin = np.sin(2 * np.pi * total_input_range.hour / 24.0)
-            hour_cos = np.cos(2 * np.pi * total_input_range.hour / 24.0)
-            X_all[batch_id, :, index]  = hour_sin
-            index += 1
-            X_all[batch_id, :, index]  = hour_cos
-            index += 1
-
-            # Convert day-of-year to cyclical features
-            day_of_year_sin = np.sin(2 * np.pi * total_input_range.day_of_year / 366)
-            day_of_year_cos = np.cos(2 * np.pi * total_input_range.day_of_year / 366)
-            X_all[batch_id, :, index]  = day_of_year_sin
-            index += 1
-            X_all[batch_id, :, index]  = day_of_year_cos
-            index += 1
-
-            # Optionally add lagged profiles
-            if self.addLaggedPower == True:
-                # Add exactly the day one, two and three weeks ago.
-                for day in range(1, 1 + self.nr_of_lagged_days):                    
-                    start = next_prediction_date - pd.Timedelta(days=day*7)
-                    end = start + self.prediction_horizon
-                    lagged_power = powerProfiles.loc[start:end]
-                    X_all[batch_id, :, index]  = np.array(lagged_power.values)
-                    index += 1
-
-            # If available: Add past weather measurmenents to the model input
-            if weatherData is not None:
-                weatherData_slice = weatherData.loc[next_prediction_date-self.prediction_horizon:next_prediction_date]
-                weather_seq_len = weatherData_slice.shape[0]
-                for feature in weatherData_slice.columns:
-                    X_all[batch_id, :weather_seq_len, index]  = weatherData_slice[feature][:]
-                    index += 1
-            else:
-                X_all[batch_id, :, index:num_of_weather_features]  = 0.0
-                index += num_of_weather_features
+        return CalendarFeatureCache.nr_of_features + self.laggedPowerOffsets.index(lagged_offset)
 
-            # Go to the next prediction (= batch)
-            next_prediction_date += self.prediction_rate
-            batch_id += 1
+    # Return the shape of the community axis, i.e. () for a single profile given as Series and
+    # (nr_of_communities,) for several profiles given as columns of a DataFrame.
+    #
+    def getCommunityShape(self, powerProfiles):
+
+        if powerProfiles is None or isinstance(powerProfiles, pd.Series):
+            return ()
+        else:
+            return (powerProfiles.shape[1],)
+
+    # Return the positions of all timesteps of all batches with shape (nr_of_batches, timesteps).
+    # A position counts the sampling intervals since the first prediction date.
+    #
+    def getBatchPositions(self):
+
+        nr_of_timesteps = self.prediction_horizon // self.sampling_time + 1
+        steps_per_prediction = self.prediction_rate // self.sampling_time
+        assert steps_per_prediction * self.sampling_time == self.prediction_rate, \
+            "The 'prediction_rate' must be a multiple of the 'sampling_time'."
+
+        # Number of predictions, that fit until the last available timestamp
+        available_range = self.last_available_datetime - self.first_prediction_date - self.prediction_horizon
+        if available_range < pd.Timedelta(0):
+            nr_of_batches = 0
+        else:
+            nr_of_batches = available_range // self.prediction_rate + 1
+
+        positions = np.arange(nr_of_batches)[:, np.newaxis] * steps_per_prediction + np.arange(nr_of_timesteps)
+
+        return positions
+
+    # Return the number of sampling intervals from the given timestamp to the first prediction date.
+    #
+    def getGridOffset(self, first_timestamp):
+
+        grid_offset = (self.first_prediction_date - first_timestamp) // self.sampling_time
+        assert first_timestamp + grid_offset * self.sampling_time == self.first_prediction_date, \
+            "The first prediction date must lie on the sampling grid of the profile."
+
+        return grid_offset
 
-        return X_all
-    
     # Convert the given power profiles to the model format.
     # For more informations regarding the shape see model design for this project.
     #
     def formattingY(self, df):
-        
-        batch_id = 0
-        next_prediction_date = self.first_prediction_date
 
-        # Calculate/define the shape of Y
-        seq_end_time = self.first_prediction_date + self.prediction_horizon
-        nr_of_timesteps = len(pd.date_range(start=self.first_prediction_date, end=seq_end_time, freq=self.sampling_time))
-        Y_all = np.zeros(shape=(0, nr_of_timesteps, 1))
+        # Get a strided view of shape ([nr_of_communities,] nr_of_batches, timesteps) on the 
+        # (regularly sampled) profiles
+        grid_offset = self.getGridOffset(df.index[0])
+        demandprofile_windows = self.getSlidingWindows(np.asarray(df.values)[grid_offset:])
 
-        while next_prediction_date + self.prediction_horizon <= self.last_available_datetime:
-            
-            # Add a new batch to the Y array
-            new_values = np.zeros(shape=(1, nr_of_timesteps, 1))
-            Y_all = np.concatenate((Y_all, new_values), axis=0)
+        # Set all target power values. This is the only copy of the profile values.
+        Y_all = np.array(demandprofile_windows[..., np.newaxis], dtype=self.dtype)
 
-            # Get values within the specified time range
-            end_prediction_horizon = next_prediction_date + self.prediction_horizon
-            demandprofile_slice = df.loc[next_prediction_date:end_prediction_horizon]
-            
-            # Set all target power values
-            Y_all[batch_id, :, 0] = demandprofile_slice
+        return Y_all
 
-            # Go to the next prediction (= batch)
-            next_prediction_date += self.prediction_rate
-            batch_id += 1
+    # Return a read-only, strided view of shape (nr_of_batches, timesteps) on the given values.
+    # For 2-dimensional values (timesteps, nr_of_communities) the shape of the view is 
+    # (nr_of_communities, nr_of_batches, timesteps). The first value must correspond to the first prediction date.
+    #
+    def getSlidingWindows(self, values):
 
-        return Y_all
+        nr_of_timesteps = self.prediction_horizon // self.sampling_time + 1
+        steps_per_prediction = self.prediction_rate // self.sampling_time
+        nr_of_batches = self.getBatchPositions().shape[0]
+
+        if nr_of_batches == 0:
+            return np.zeros(shape=(*values.shape[1:], 0, nr_of_timesteps), dtype=values.dtype)
+
+        windows = np.lib.stride_tricks.sliding_window_view(values, nr_of_timesteps, axis=0)
+        windows = windows[:(nr_of_batches - 1) * steps_per_prediction + 1:steps_per_prediction]
+
+        # Move the (optional) community axis to the front
+        if windows.ndim == 3:
+            windows = np.moveaxis(windows, 1, 0)
 
-    # Convert from nd-array to torch tensor
+        return windows
+
+    # Convert from nd-array to torch tensor.
+    # The tensors share the memory with the given arrays (no copy).
     #
     def convertToTorchTensor(self, X_all, Y_all):        
         
-        for dataset in X_all:
-            X_all[dataset] = torch.tensor(X_all[dataset])       
-             
-        for dataset in Y_all:
-            Y_all[dataset] = torch.tensor(Y_all[dataset])
+        X_all.data = torch.from_numpy(np.ascontiguousarray(X_all.data))
+        Y_all.data = torch.from_numpy(np.ascontiguousarray(Y_all.data))
             
         return X_all, Y_all
         
     # Normalize all the inputs and targets of the model.
     #
-    def normalizeAll(self, X_all, Y_all):
+    # Optionally, the statistics of X were already estimated on the train set (e.g. by formattingX).
+    #
+    def normalizeAll(self, X_all, Y_all, statisticsX=None):
         
-        X_all['train'] = self.normalizeX(X_all['train'], training=True)
-        Y_all['train'] = self.normalizeY(Y_all['train'], training=True)
-        X_all['dev'] = self.normalizeX(X_all['dev'], training=False)
-        Y_all['dev'] = self.normalizeY(Y_all['dev'], training=False)
-        X_all['test'] = self.normalizeX(X_all['test'], training=False)
-        Y_all['test'] = self.normalizeY(Y_all['test'], training=False)
-        X_all['all'] = self.normalizeX(X_all['all'], training=False)
-        Y_all['all'] = self.normalizeY(Y_all['all'], training=False)
+        # Estimate the statistics on the train set. The train samples are streamed in chunks,
+        # so the (non-contiguous) train set is never gathered as a whole.
+        train_indices = X_all.getIndices('train')
+        statisticsY = self.createStatistics(Y_all.data)
+        if statisticsX is None:
+            statisticsX = self.createStatistics(X_all.data)
+            for start in range(0, len(train_indices), self.statistics_chunk_size):
+                statisticsX.update(X_all.data[..., train_indices[start:start + self.statistics_chunk_size], :, :])
+        for start in range(0, len(train_indices), self.statistics_chunk_size):
+            statisticsY.update(Y_all.data[..., train_indices[start:start + self.statistics_chunk_size], :, :])
+        self.setStatisticsX(statisticsX)
+        self.setStatisticsY(statisticsY)
+
+        # Normalize the shared data of all sets at once
+        X_all.data = self.normalizeX(X_all.data, training=False)
+        Y_all.data = self.normalizeY(Y_all.data, training=False)
         
         return X_all, Y_all
         
@@ -237,18 +350,27 @@ class ModelAdapter:
     def normalizeX(self, X, training=False):
 
         if training:
-            # Estimate the mean and standard deviation of the data during training
-            self.meanX = np.mean(X, axis=(0, 1))
-            self.stdX = np.std(X, axis=(0, 1))
-        
-            if np.isclose(self.stdX, 0).any():
-                # Avoid a division by zero (which can occur for constant features)
-                self.stdX = np.where(np.isclose(self.stdX, 0), 1e-8, self.stdX)
+            # Estimate the mean and standard deviation of the data during training.
+            self.setStatisticsX(self.createStatistics(X).update(X))
 
         X_normalized = (X - self.meanX) / self.stdX
 
         return X_normalized
 
+    # Set the normalization statistics of X from the given (streamed) statistics.
+    # For several communities, the statistics are estimated per community and have the
+    # shape (nr_of_communities, 1, 1, features).
+    #
+    def setStatisticsX(self, statistics):
+
+        dtype = np.dtype(self.dtype)
+        self.meanX = statistics.getMean().astype(dtype)
+        self.stdX = statistics.getStd().astype(dtype)
+    
+        if np.isclose(self.stdX, 0).any():
+            # Avoid a division by zero (which can occur for constant features)
+            self.stdX = np.where(np.isclose(self.stdX, 0), 1e-8, self.stdX).astype(dtype)
+
     # Undo z-normalization
     #
     def deNormalizeX(self, X):
@@ -263,10 +385,9 @@ class ModelAdapter:
 
         if training:
             # Estimate the mean and standard deviation of the data during training
-            self.meanY = np.mean(Y, axis=(0, 1))
-            self.stdY = np.std(Y)
+            self.setStatisticsY(self.createStatistics(Y).update(Y))
         
-        if np.isclose(self.stdY, 0):
+        if np.isclose(self.stdY, 0).any():
             assert False, "Normalization leads to division by zero."
 
         Y_normalized = (Y - self.meanY) / self.stdY
@@ -280,13 +401,55 @@ class ModelAdapter:
         Y_denormalized = (Y * self.stdY) + self.meanY
 
         return Y_denormalized
+
+    # Set the normalization statistics of Y from the given (streamed) statistics.
+    # The mean is estimated per output, the standard deviation over all outputs.
+    #
+    def setStatisticsY(self, statistics):
+
+        dtype = np.dtype(self.dtype)
+        self.meanY = statistics.getMean().astype(dtype)
+        if statistics.keepdims:
+            self.stdY = statistics.pool(axis=-1).getStd().astype(dtype)
+        else:
+            self.stdY = dtype.type(statistics.pool(axis=-1).getStd())
+
+    # Return an empty accumulator of the normalization statistics of the given data.
+    #
+    def createStatistics(self, data):
+
+        sample_axes, per_community = self.getSampleAxes(data)
+
+        return RunningStatistics(axis=sample_axes, keepdims=per_community)
+
+    # Return the axes of the samples (i.e. batches and timesteps) of the given data and whether
+    # the data contains a leading community axis.
+    #
+    def getSampleAxes(self, data):
+
+        per_community = data.ndim == 4
+        sample_axes = (1, 2) if per_community else (0, 1)
+
+        return sample_axes, per_community
+
+    # Return a model adapter of a single community of a batch transformation, 
+    # i.e. with the normalization statistics of the given community.
+    #
+    def getCommunityAdapter(self, community_index):
+
+        communityAdapter = copy.copy(self)
+        communityAdapter.meanX = self.meanX[community_index, 0, 0]
+        communityAdapter.stdX = self.stdX[community_index, 0, 0]
+        communityAdapter.meanY = self.meanY[community_index, 0, 0]
+        communityAdapter.stdY = self.stdY[community_index, 0, 0, 0]
+
+        return communityAdapter
     
-    # Split up the data into train-, dev- and test-set
+    # Split up the samples into train-, dev- and test-set and return the indices of all sets.
     #
-    def splitUpData(self, X_all, Y_all):
+    def splitUpSamples(self, total_samples):
 
         # Optionally shuffle all indices
-        total_samples = X_all.shape[0]
         self.shuffeled_indices = np.arange(total_samples)
         if self.shuffle_data == True:
             np.random.shuffle(self.shuffeled_indices)
@@ -304,8 +467,7 @@ class ModelAdapter:
         # |                   X['all'] (entire timeseries)                    |
         # |                   Y['all'] (entire timeseries)                    |
         #  -------------------------------------------------------------------        
-        X, Y = {}, {}
-        self.total_set_size = X_all.shape[0]
+        self.total_set_size = total_samples
         self.dev_set_start = self.total_set_size - self.devSize
         self.trainFuture_start = self.dev_set_start - self.trainFuture
         self.test_set_start = self.trainFuture_start - self.testSize
@@ -313,24 +475,22 @@ class ModelAdapter:
             self.train_set_start = self.test_set_start - self.trainHistory
         else:
             self.train_set_start = None # Set train length to max
-        
-        X['dev'] = X_all[self.shuffeled_indices[self.dev_set_start:]]
-        X['test'] = X_all[self.shuffeled_indices[self.test_set_start:self.trainFuture_start]]
-        X['train'] = np.concatenate([
-                        X_all[self.shuffeled_indices[self.train_set_start:self.test_set_start]],
-                        X_all[self.shuffeled_indices[self.trainFuture_start:self.dev_set_start]]
-                    ])
-        X['all'] = X_all[:]
-        
-        Y['dev'] = Y_all[self.shuffeled_indices[self.dev_set_start:]]
-        Y['test'] = Y_all[self.shuffeled_indices[self.test_set_start:self.trainFuture_start]]
-        Y['train'] = np.concatenate([
-                        Y_all[self.shuffeled_indices[self.train_set_start:self.test_set_start]],
-                        Y_all[self.shuffeled_indices[self.trainFuture_start:self.dev_set_start]]
-                    ])
-        Y['all'] = Y_all[:]
 
-        return X, Y
+
+        return self.getSplitIndices()
+
+    # Return the indices of the train, dev and test set on all data.
+    #
+    def getSplitIndices(self):
+
+        split_indices = {}
+        split_indices['dev'] = self.shuffeled_indices[self.dev_set_start:]
+        split_indices['test'] = self.shuffeled_indices[self.test_set_start:self.trainFuture_start]
+        split_indices['train'] = np.concatenate([
+                        self.shuffeled_indices[self.train_set_start:self.test_set_start],
+                        self.shuffeled_indices[self.trainFuture_start:self.dev_set_start]
+                    ])
+        return split_indices
 
     # Return the unshuffled index in all data that corresponds to the given
     # dataset_tye and index.
@@ -364,6 +524,17 @@ class ModelAdapter:
 
         return self.first_prediction_date + index * self.prediction_rate
 
+    # Return the prediction dates of all samples of the given dataset_type (in the order of the samples).
+    #
+    def getStartDates(self, dataset_type):
+
+        if dataset_type == 'all':
+            indices = np.arange(self.total_set_size)
+        else:
+            indices = self.getSplitIndices()[dataset_type]
+
+        return self.first_prediction_date + pd.to_timedelta(indices * self.prediction_rate.value, unit='ns')
+
     # Return the dataset-type (train, test, ...) from the given unshuffeled index
     #
     def getDatasetTypeFromIndex(self, unshuffeled_index):
@@ -385,6 +556,200 @@ class ModelAdapter:
 
         return dataset_type
 
+# The train, dev, test and all sets of the model data.
+# The data is stored only once (with the samples on the third last axis) and each set is 
+# represented by indices on it. Contiguous sets (e.g. all sets of unshuffled data) are returned 
+# as views, the other sets are gathered on access. To avoid the gather, use getDataAndIndices.
+#
+class DatasetSplits(Mapping):
+
+    def __init__(self, data, split_indices):
+        self.data = data
+        self.split_indices = split_indices
+
+    def __getitem__(self, dataset_type):
+
+        if dataset_type == 'all':
+            return self.data
+
+        data, indices = self.getDataAndIndices(dataset_type)
+        if indices is None:
+            return data
+        else:
+            return data[..., indices, :, :]
+
+    # Return the given set as a view on the shared data and None, if it is contiguous. 
+    # Otherwise, return the shared data itself together with the indices of the set (no copy).
+    #
+    def getDataAndIndices(self, dataset_type):
+
+        if dataset_type == 'all':
+            return self.data, None
+
+        indices = self.getIndices(dataset_type)
+        if len(indices) > 0 and np.all(np.diff(indices) == 1):
+            return self.data[..., indices[0]:indices[-1] + 1, :, :], None
+        else:
+            return self.data, indices
+
+    def __iter__(self):
+        return iter(['train', 'dev', 'test', 'all'])
+
+    def __len__(self):
+        return 4
+
+    # Return the indices of the given set on the shared data.
+    #
+    def getIndices(self, dataset_type):
+
+        if dataset_type == 'all':
+            return np.arange(self.data.shape[-3])
+        else:
+            return self.split_indices[dataset_type]
+
+    # Return the sets of a single community of a batch transformation.
+    # The data of the community is copied, so that it can be persisted without the other communities.
+    #
+    def getCommunity(self, community_index):
+
+        return DatasetSplits(self.data[community_index].clone(), self.split_indices)
+
+# Streaming mean and standard deviation (Welford/Chan).
+#
+# The statistics are reduced over the given axes and can be fed chunk by chunk (e.g. while the
+# features are produced) or merged with the statistics of other shards or processes. The moments 
+# are accumulated in double precision, the result matches np.mean/np.std over all chunks.
+#
+class RunningStatistics:
+
+    def __init__(self, axis, keepdims=False):
+        self.axis = tuple(axis)
+        self.keepdims = keepdims
+        self.count = 0
+        self.mean = None
+        self.m2 = None      # Sum of the squared deviations from the mean
+
+    # Add the given chunk of data.
+    #
+    def update(self, chunk):
+
+        chunk = np.asarray(chunk)
+        count = int(np.prod([chunk.shape[axis] for axis in self.axis]))
+        if count == 0:
+            return self
+
+        mean = np.mean(chunk, axis=self.axis, keepdims=True, dtype=np.float64)
+        m2 = np.sum(np.square(chunk - mean), axis=self.axis, keepdims=True)
+
+        return self.mergeMoments(count, mean, m2)
+
+    # Add the statistics of another accumulator (e.g. of another shard).
+    #
+    def merge(self, other):
+        return self.mergeMoments(other.count, other.mean, other.m2)
+
+    def mergeMoments(self, count, mean, m2):
+
+        if count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return self
+
+        total_count = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total_count)
+        self.m2 = self.m2 + m2 + np.square(delta) * (self.count * count / total_count)
+        self.count = total_count
+
+        return self
+
+    # Return the statistics, that are additionally reduced over the given axis.
+    #
+    def pool(self, axis):
+
+        pooled = RunningStatistics(self.axis + (axis,), self.keepdims)
+        pooled.count = self.count * self.mean.shape[axis]
+        pooled.mean = np.mean(self.mean, axis=axis, keepdims=True)
+        pooled.m2 = np.sum(self.m2, axis=axis, keepdims=True) \
+                    + self.count * np.sum(np.square(self.mean - pooled.mean), axis=axis, keepdims=True)
+
+        return pooled
+
+    def getMean(self):
+        return self.getReducedShape(self.mean)
+
+    # Return the (population) standard deviation, like np.std.
+    #
+    def getStd(self):
+        return self.getReducedShape(np.sqrt(self.m2 / self.count))
+
+    def getReducedShape(self, value):
+        if self.keepdims:
+            return value
+        return np.squeeze(value, axis=self.axis)
+
+# Cache the calendar features (weekday one-hot encoding with public holidays as Sundays,
+# cyclical clock time and day-of-year) of regular time grids. Those features don't depend on
+# the load profile, so one cache can be shared by all model adapters of a simulation run.
+#
+class CalendarFeatureCache:
+
+    nr_of_features = 11
+
+    def __init__(self):
+        self.cached_features = {}
+
+    # Return the calendar features with shape (len(time_grid), nr_of_features).
+    # Cached features of a longer grid with the same start are reused.
+    #
+    def getFeatures(self, time_grid, public_holidays):
+
+        holiday_key = tuple(np.unique(pd.DatetimeIndex(public_holidays).asi8))
+        key = (time_grid[0] if len(time_grid) > 0 else None, time_grid.freq, holiday_key)
+
+        cached = self.cached_features.get(key)
+        if cached is None or cached.shape[0] < len(time_grid):
+            cached = self.calculateFeatures(time_grid, np.array(holiday_key, dtype=np.int64))
+            cached.setflags(write=False)
+            self.cached_features[key] = cached
+
+        return cached[:len(time_grid)]
+
+    # Calculate the calendar features of the given time grid.
+    #
+    @staticmethod
+    def calculateFeatures(time_grid, holiday_timestamps):
+
+        features = np.zeros(shape=(len(time_grid), CalendarFeatureCache.nr_of_features))
+
+        # Get the current weekday indices [0 ... 6] of all timesteps.
+        weekday_numbers = time_grid.weekday.values.copy()
+
+        # Identify public holidays and replace that day with Sunday.
+        # The holiday lookup is done once per day of the grid and then broadcasted to all timesteps.
+        day_timestamps, day_index = np.unique(time_grid.floor("D").asi8, return_inverse=True)
+        is_public_holiday = np.isin(day_timestamps, holiday_timestamps)
+        weekday_numbers[is_public_holiday[day_index]] = 6
+
+        # Create a one-hot encoding array with shape (nr_of_timesteps, 7).
+        index = 7
+        features[:, :index] = np.eye(7)[weekday_numbers]
+
+        # Convert clock_time to cyclical features
+        features[:, index] = np.sin(2 * np.pi * time_grid.hour / 24.0)
+        index += 1
+        features[:, index] = np.cos(2 * np.pi * time_grid.hour / 24.0)
+        index += 1
+
+        # Convert day-of-year to cyclical features
+        features[:, index] = np.sin(2 * np.pi * time_grid.day_of_year / 366)
+        index += 1
+        features[:, index] = np.cos(2 * np.pi * time_grid.day_of_year / 366)
+        index += 1
+
+        return features
+
 if __name__ == '__main__':
     pass
 
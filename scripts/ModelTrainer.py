@@ -1,9 +1,11 @@
 import pandas as pd
 import holidays
 import pytz
-from demandlib import bdew
-import pickle
 from datetime import timedelta, date
+import concurrent.futures
+import hashlib
+import json
+import torch
 import sys
 import os
 
@@ -21,44 +23,179 @@ import scripts.Simulation_config
 import data.weather_data as weather_data
 import scripts.ModelAdapter as ModelAdapter
 import scripts.Utils as Utils
+import scripts.FeatureStore as FeatureStore
 
 
 class ModelTrainer:
     
-    def __init__(self):
+    def __init__(self, featureStore=None, preprocessingCache=None, weatherMeasurements=None, trainingOptions=None,
+                 pretrainedWeightsStore=None, resultStore=None):
         
         self.test_set_size_days = 131    # Size of the testset is fixed to 131 days ~ 4 month
+        self.pretraining_filename = 'scripts/outputs/standard_loadprofile.pkl'
+
+        # Additional arguments of Model.train_model, e.g. {'patience': 5, 'eval_every': 2, 'time_budget': 600}
+        self.trainingOptions = trainingOptions if trainingOptions is not None else {}
+
+        # Memory-mapped storage of the preprocessed profiles (optionally with float16 encoding)
+        if featureStore is None:
+            featureStore = FeatureStore.FeatureStore()
+        self.featureStore = featureStore
+
+        # Cache of the preprocessed data, which is shared by configs with the same data settings
+        if preprocessingCache is None:
+            preprocessingCache = FeatureStore.PreprocessingCache()
+        self.preprocessingCache = preprocessingCache
+
+        # Locally cached weather measurements (use offline=True on machines without internet access)
+        if weatherMeasurements is None:
+            weatherMeasurements = weather_data.WeatherMeasurements()
+        self.weatherMeasurements = weatherMeasurements
+
+        # Per-year cache of the BDEW standard load profiles
+        self.standardLoadProfileStore = FeatureStore.StandardLoadProfileStore()
+
+        # Pretrained weights, shared by all configs with the same pretraining
+        if pretrainedWeightsStore is None:
+            pretrainedWeightsStore = FeatureStore.PretrainedWeightsStore()
+        self.pretrainedWeightsStore = pretrainedWeightsStore
+
+        # Results of the finished training jobs (persisted as soon as a job is done)
+        if resultStore is None:
+            resultStore = Utils.ResultStore()
+        self.resultStore = resultStore
             
-    def run(self, configs):
+    # Train and evaluate all given configs.
+    # With resume=True, the jobs, whose results are already in the result store (e.g. of an interrupted
+    # run) and were trained the same way (see get_training_hash), are skipped. Use resume=False to train 
+    # everything again (e.g. after changes of the code).
+    #
+    def run(self, configs, preprocessing_workers=1, multi_community_training=False, training_workers=1, 
+            threads_per_worker=1, store_quantized=False, resume=True):
         
+        # Fail early, if the training options aren't supported by the joint training
+        if multi_community_training:
+            self.get_joint_training_options()
+
+        # Optionally run the training jobs in a process pool (with pinned torch threads per worker)
+        if training_workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=training_workers, 
+                                                              initializer=_init_training_worker,
+                                                              initargs=(self, threads_per_worker))
+        else:
+            executor = None
+
         # Run every single config
-        all_train_histories, all_trained_models = {}, {}
+        all_result_keys = []
         for act_sim_config_index in range(len(configs)):
             
             # Fetch and prepare all needed data
-            loadprofiles = self.preprocess_data(configs, act_sim_config_index)
+            loadprofiles = self.preprocess_data(configs, act_sim_config_index, workers=preprocessing_workers)
             
             # Train and test the given models
             act_sim_config = configs[act_sim_config_index]
-            results = []
+            jobs = []
             for model_type in act_sim_config.usedModels:
-                for load_profile in loadprofiles:
-                    result = self.optimize_model(model_type, load_profile, configs, act_sim_config_index)
-                    results.append(result)
-
-            # Store the results into dicts
-            model_types, load_profiles, sim_configs, histories, returnedModels = zip(*results)
-            for i in range(len(model_types)):
-                result_key = (model_types[i], load_profiles[i], sim_configs[i])
-                all_train_histories[result_key] = histories[i]
-                all_trained_models[result_key] = returnedModels[i]
+                if multi_community_training:
+                    # Train the models of all communities at once
+                    jobs.append((model_type, loadprofiles))
+                else:
+                    jobs += [(model_type, load_profile) for load_profile in loadprofiles]
+            all_result_keys += [(model_type, load_profile, act_sim_config) 
+                                for model_type in act_sim_config.usedModels for load_profile in loadprofiles]
+
+            # Skip the jobs, which are already finished
+            if resume:
+                nr_of_jobs = len(jobs)
+                jobs = [(model_type, load_profiles) for model_type, load_profiles in jobs 
+                        if not self.is_job_finished(model_type, load_profiles, act_sim_config)]
+                if len(jobs) < nr_of_jobs:
+                    print(f"Skipping {nr_of_jobs - len(jobs)} finished training jobs of sim_config "
+                          f"{act_sim_config_index+1}/{len(configs)}.", flush=True)
+            self.run_training_jobs(jobs, configs, act_sim_config_index, executor, store_quantized)
+
+        if executor is not None:
+            executor.shutdown()
         
-        # Persist all results
-        Utils.Serialize.store_results_with_pickle(all_train_histories)
-        Utils.Serialize.store_results_with_torch(all_trained_models)
+        # Build the output files of this run from the stored results
+        Utils.Serialize.store_results_from_result_store(self.resultStore, all_result_keys)
         
         return
     
+    # Return True, if the results of all load profiles of the given job are already stored.
+    # Results of other (e.g. regenerated) data or other training options don't count.
+    #
+    def is_job_finished(self, model_type, load_profiles, sim_config):
+
+        multi_community_training = isinstance(load_profiles, list)
+        if not multi_community_training:
+            load_profiles = [load_profiles]
+
+        return all(self.resultStore.contains((model_type, load_profile, sim_config), 
+                                             training_hash=self.get_training_hash(load_profile, 
+                                                                                  multi_community_training)) 
+                   for load_profile in load_profiles)
+
+    # Return the hash of everything, that determines a result besides its key: The content of the 
+    # preprocessed profile, the training options and whether the communities were trained jointly.
+    #
+    def get_training_hash(self, load_profile, multi_community_training):
+
+        hash_data = {
+            'data_hash': self.featureStore.getContentHash(load_profile),
+            'training_options': {name: str(value) for name, value in sorted(self.trainingOptions.items())},
+            'multi_community_training': multi_community_training,
+        }
+        return hashlib.sha256(json.dumps(hash_data, sort_keys=True).encode()).hexdigest()[:32]
+
+    # Run the given training jobs of one config and store their results, as soon as every job is done.
+    # The preprocessed data is overwritten by the next config, so all jobs have to finish here.
+    #
+    def run_training_jobs(self, jobs, configs, act_sim_config_index, executor=None, store_quantized=False):
+
+        if executor is None:
+            for model_type, load_profiles in jobs:
+                results = self.run_training_job(model_type, load_profiles, configs, act_sim_config_index)
+                self.store_results(results, isinstance(load_profiles, list), store_quantized)
+        else:
+            # Start the longest jobs first, so that all workers finish at about the same time.
+            # The workers store their results themselves.
+            job_order = sorted(range(len(jobs)), key=lambda i: self.get_training_cost_rank(jobs[i][0]))
+            futures = [executor.submit(_run_training_job_in_worker, *jobs[i], configs, act_sim_config_index, 
+                                       store_quantized) 
+                       for i in job_order]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()     # Raise the exceptions of the workers
+
+    # Persist the given results of a training job in the result store.
+    #
+    def store_results(self, results, multi_community_training, store_quantized=False):
+
+        for model_type, load_profile, sim_config, history, trained_model in results:
+            self.resultStore.write((model_type, load_profile, sim_config), history, trained_model, 
+                                   store_quantized=store_quantized, 
+                                   training_hash=self.get_training_hash(load_profile, multi_community_training))
+
+    # Train and evaluate the given model type for one load profile (or for a list of load profiles jointly).
+    #
+    def run_training_job(self, model_type, load_profiles, configs, act_sim_config_index):
+
+        if isinstance(load_profiles, list):
+            return self.optimize_models_jointly(model_type, load_profiles, configs, act_sim_config_index)
+        else:
+            return [self.optimize_model(model_type, load_profiles, configs, act_sim_config_index)]
+
+    # Return the rank of the training time of the given model type (0 = longest).
+    #
+    @staticmethod
+    def get_training_cost_rank(model_type):
+
+        longest_first = ('xLSTM', 'Transformer', 'LSTM')    # KNN and the baselines are fast
+        if model_type in longest_first:
+            return longest_first.index(model_type)
+        else:
+            return len(longest_first)
+
     # Do Model training and evaluation
     # 
     def optimize_model(self, model_type, load_profile, configs, act_sim_config_index):
@@ -66,85 +203,261 @@ class ModelTrainer:
         print(f"\nProcessing model {model_type} with load profile {load_profile} and sim_config {act_sim_config_index+1}/{len(configs)}.", flush=True)
 
         # Load a new powerprofile
-        with open(load_profile, 'rb') as f:
-            (X, Y, modelAdapter) = pickle.load(f)
+        X, Y, modelAdapter = self.featureStore.read(load_profile)
 
         # Train and evaluate the model
         sim_config = configs[act_sim_config_index]
-        num_of_features = X['train'].shape[2]
-        myModel = model.Model(model_type, sim_config.modelSize, num_of_features, modelAdapter=modelAdapter)
-        history = myModel.train_model(X['train'], Y['train'], pretrain_now=False,
-                                    finetune_now=sim_config.doTransferLearning, epochs=sim_config.epochs)
-        history = myModel.evaluate(X['test'], Y['test'], results=history, deNormalize=True)
+        num_of_features = X['all'].shape[2]
+        myModel = model.Model(model_type, sim_config.modelSize, num_of_features, modelAdapter=modelAdapter,
+                              standardLoadProfile=self.get_standard_load_profile(model_type))
+        # Non-contiguous sets (e.g. shuffled data) are passed as shared data plus indices and gathered per batch
+        X_train, train_indices = X.getDataAndIndices('train')
+        Y_train, _ = Y.getDataAndIndices('train')
+        X_dev, dev_indices = X.getDataAndIndices('dev')
+        Y_dev, _ = Y.getDataAndIndices('dev')
+        history = myModel.train_model(X_train, Y_train, X_dev, Y_dev, pretrain_now=False,
+                                    finetune_now=sim_config.doTransferLearning, 
+                                    pretrained_weights=self.get_pretrained_weights(model_type, sim_config, num_of_features),
+                                    epochs=sim_config.epochs, train_indices=train_indices, dev_indices=dev_indices,
+                                    profile_trace_path=self.get_profile_trace_path(model_type, load_profile, 
+                                                                                   act_sim_config_index),
+                                    **self.trainingOptions)
+        history = myModel.evaluate(X['test'], Y['test'], results=history, deNormalize=True, 
+                                   dates=modelAdapter.getStartDates('test'), 
+                                   precision=self.trainingOptions.get('precision', 'fp32'))
         
         # Return the results
         return (model_type, load_profile, sim_config, history, myModel.my_model)
 
-    def preprocess_data(self, configs, act_sim_config_index):
+    # Return the path of the (optional) profiler trace of the given training job, 
+    # i.e. one file per model type, load profile and config.
+    #
+    def get_profile_trace_path(self, model_type, load_profile, act_sim_config_index):
+
+        profile_name = os.path.splitext(os.path.basename(load_profile))[0]
+        return f'scripts/outputs/profiler_trace_{model_type}_{profile_name}_config{act_sim_config_index}.json'
+
+    # Do Model training of all given load profiles in one training loop, followed by the
+    # evaluation of every single model
+    #
+    def optimize_models_jointly(self, model_type, load_profiles, configs, act_sim_config_index):
+        
+        print(f"\nProcessing model {model_type} with {len(load_profiles)} load profiles and sim_config {act_sim_config_index+1}/{len(configs)}.", flush=True)
+
+        # Load all powerprofiles
+        all_data = [self.featureStore.read(load_profile) for load_profile in load_profiles]
+        X_train = torch.stack([X['train'] for X, _, _ in all_data])
+        Y_train = torch.stack([Y['train'] for _, Y, _ in all_data])
+
+        # Train all models at once
+        sim_config = configs[act_sim_config_index]
+        num_of_features = X_train.shape[3]
+        modelAdapters = [modelAdapter for _, _, modelAdapter in all_data]
+        multiModel = model.MultiCommunityModel(model_type, sim_config.modelSize, num_of_features, modelAdapters,
+                                               standardLoadProfile=self.get_standard_load_profile(model_type))
+        histories = multiModel.train_model(X_train, Y_train, finetune_now=sim_config.doTransferLearning, 
+                                           pretrained_weights=self.get_pretrained_weights(model_type, sim_config, 
+                                                                                          num_of_features),
+                                           epochs=sim_config.epochs, **self.get_joint_training_options())
+
+        # Evaluate the model of every community
+        results = []
+        for i, (X, Y, modelAdapter) in enumerate(all_data):
+            myModel = multiModel.models[i]
+            history = myModel.evaluate(X['test'], Y['test'], results=histories[i], deNormalize=True, 
+                                       dates=modelAdapter.getStartDates('test'), 
+                                       precision=self.trainingOptions.get('precision', 'fp32'))
+            results.append((model_type, load_profiles[i], sim_config, history, myModel.my_model))
+
+        return results
+
+    # Return the training options for MultiCommunityModel.train_model. The joint training has no dev set, 
+    # so the options for early stopping and evaluation (e.g. 'patience') and the profiling aren't supported.
+    #
+    def get_joint_training_options(self):
+
+        supported_options = ('set_learning_rates', 'batch_size', 'time_budget', 'precision')
+        unsupported_options = [option for option in self.trainingOptions if option not in supported_options]
+        if len(unsupported_options) > 0:
+            raise ValueError(f"The training options {unsupported_options} aren't supported with "
+                             "multi_community_training=True.")
+
+        return self.trainingOptions
+
+    def preprocess_data(self, configs, act_sim_config_index, workers=1):
         
         sim_config = configs[act_sim_config_index]
         if sim_config.epochs <= 5:
             print(f"WARNING: Only {sim_config.epochs} epochs chosen. Please check, if this really fits your needs.")
         print(f"\n\nDo Data Preprocessing for run config={sim_config}.", flush=True)
+        pretraining_filename = self.pretraining_filename
         
+        # Configs, that only differ in e.g. the model size or the epochs, share the same preprocessed data
+        cache_key = self.get_preprocessing_key(sim_config) if self.preprocessingCache is not None else None
+        if cache_key is not None and self.preprocessingCache.contains(cache_key):
+            print(f"Reusing the cached preprocessing {cache_key}.", flush=True)
+            cached_filenames = self.preprocessingCache.restore(cache_key, self.featureStore)
+            loadProfiles_filenames = [filename for filename in cached_filenames if filename != pretraining_filename]
+        else:
+            loadProfiles_filenames = self.transform_data(sim_config, pretraining_filename, workers)
+            if cache_key is not None:
+                self.preprocessingCache.store(cache_key, self.featureStore, 
+                                              loadProfiles_filenames + [pretraining_filename])
+        X, Y, _ = self.featureStore.read(pretraining_filename)
+        
+        # If required, do pretraining
+        if sim_config.doPretraining:
+            
+            # Do model pretraining (unless the same pretraining was already done, e.g. by another config)
+            for model_type in sim_config.usedModels:
+                num_of_features = X['all'].shape[2]
+                key = self.get_pretrained_weights_key(model_type, sim_config, num_of_features)
+                if self.pretrainedWeightsStore.contains(key):
+                    print(f"\nReusing the pretrained {model_type} weights {key}.", flush=True)
+                    continue
+                print(f"\nPretraining {model_type} model and and sim_config {act_sim_config_index+1}/{len(configs)}.", flush=True)
+                myModel = model.Model(model_type, sim_config.modelSize, num_of_features)
+                myModel.train_model(X['all'], Y['all'], pretrain_now=True, 
+                                    finetune_now=False, epochs=sim_config.epochs, 
+                                    **self.get_pretraining_options())
+                if myModel.my_model.isPytorchModel:
+                    self.pretrainedWeightsStore.write(key, myModel.my_model.state_dict())
+
+        return loadProfiles_filenames
+
+    # Return the key of the pretrained weights of the given model and config in the PretrainedWeightsStore.
+    # The pretraining data is identified by the content hash of the preprocessed standard load profile.
+    #
+    def get_pretrained_weights_key(self, model_type, sim_config, num_of_features):
+
+        data_hash = self.featureStore.getContentHash(self.pretraining_filename)
+        return self.pretrainedWeightsStore.getKey(model_type, sim_config.modelSize, num_of_features, 
+                                                  data_hash, sim_config.epochs, self.get_pretraining_options())
+
+    # Return the training options, that also apply to the pretraining.
+    # The pretraining has no dev set, so e.g. the early stopping and the profiling are left out.
+    #
+    def get_pretraining_options(self):
+
+        supported_options = ('set_learning_rates', 'batch_size', 'time_budget', 'precision')
+        return {option: value for option, value in self.trainingOptions.items() if option in supported_options}
+
+    # Return the transformed standard load profile (Y, modelAdapter) from the feature store, 
+    # if the given model needs it.
+    #
+    def get_standard_load_profile(self, model_type):
+
+        if model_type != 'SyntheticLoadProfile':
+            return None
+
+        _, Y, standardAdapter = self.featureStore.read(self.pretraining_filename)
+        return (Y, standardAdapter)
+
+    # Return the pretrained weights of the given model and config, if finetuning is required.
+    #
+    def get_pretrained_weights(self, model_type, sim_config, num_of_features):
+
+        if not sim_config.doTransferLearning:
+            return None
+
+        key = self.get_pretrained_weights_key(model_type, sim_config, num_of_features)
+        if not self.pretrainedWeightsStore.contains(key):
+            return None     # E.g. the parameter-free models
+
+        return self.pretrainedWeightsStore.read(key)
+
+    # Transform the profiles of the given config and the standard load profile to the model data
+    # and store them into the feature store.
+    #
+    def transform_data(self, sim_config, pretraining_filename, workers=1):
+
         loadProfiles, weatherData, public_holidays_timestamps = self.load_data(sim_config)
+
+        # The calendar features are calculated once and shared by all profiles
+        calendarCache = ModelAdapter.CalendarFeatureCache()
         
-        # Bring the power profiles to the model shape of (nr_of_batches, timesteps, features)
+        # Bring the power profiles to the model shape of (nr_of_batches, timesteps, features).
+        # All communities are transformed at once, with one column per community.
         #
-        loadProfiles_filenames = []
-        for i, powerProfile in enumerate(loadProfiles[:sim_config.nrOfComunities]):
-            
-            # Preprocess data to get X and Y for the model
-            modelAdapter = ModelAdapter.ModelAdapter(public_holidays_timestamps, 
-                                                     trainHistory = sim_config.trainingHistory,
-                                                     testSize = sim_config.testSize, 
-                                                     trainFuture = sim_config.trainingFuture, 
-                                                     devSize = sim_config.devSize, 
-                                                     )
-            X, Y = modelAdapter.transformData(powerProfile, weatherData)
-            
-            out_filename = 'scripts/outputs/file_' + str(i) + '.pkl'
-            with open(out_filename, 'wb') as file:
-                pickle.dump((X, Y, modelAdapter), file)
-            loadProfiles_filenames.append(out_filename)
+        communityProfiles = pd.concat(loadProfiles[:sim_config.nrOfComunities], axis=1, ignore_index=True)
+        if workers > 1:
+            # Transform chunks of communities in a process pool. The weather data and the holidays 
+            # are sent once per worker, the results are returned in the order of the communities.
+            chunk_size = -(-communityProfiles.shape[1] // workers)    # Round up
+            chunk_starts = list(range(0, communityProfiles.shape[1], chunk_size))
+            chunks = [communityProfiles.iloc[:, start:start + chunk_size] for start in chunk_starts]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, 
+                                                        initializer=_init_preprocessing_worker,
+                                                        initargs=(self, sim_config, weatherData, 
+                                                                  public_holidays_timestamps)) as executor:
+                chunk_filenames = executor.map(_transform_communities_in_worker, chunk_starts, chunks)
+                loadProfiles_filenames = [filename for filenames in chunk_filenames for filename in filenames]
+        else:
+            loadProfiles_filenames = self.transform_communities(communityProfiles, 0, sim_config, weatherData, 
+                                                                public_holidays_timestamps, calendarCache)
 
         # Load the BDEW standard load profiles for the desired datetime range
-        standard_loadprofiles = []
         startDate = loadProfiles[0].index[0].to_pydatetime().replace(tzinfo=None)
         endDate = loadProfiles[0].index[-1].to_pydatetime().replace(tzinfo=None)
-        for year in range(startDate.year, endDate.year + 1):
-            load_profile = bdew.ElecSlp(year, holidays=public_holidays_timestamps).get_profile({"h0": 1000})
-            standard_loadprofiles.append(load_profile)
-        all_standard_loadprofiles = pd.concat(standard_loadprofiles)['h0']
-        all_standard_loadprofiles = all_standard_loadprofiles[(all_standard_loadprofiles.index >= startDate)
-                                                                & (all_standard_loadprofiles.index <= endDate)]
-        all_standard_loadprofiles = all_standard_loadprofiles.tz_localize("UTC")
+        all_standard_loadprofiles = self.standardLoadProfileStore.getProfile(startDate, endDate, 
+                                                                              public_holidays_timestamps)
         
         # Preprocess data to get X and Y for the model
-        modelAdapter = ModelAdapter.ModelAdapter(public_holidays_timestamps,
-                                                trainHistory = sim_config.trainingHistory,
-                                                testSize = sim_config.testSize,
-                                                trainFuture = sim_config.trainingFuture,
-                                                devSize = sim_config.devSize, 
-                                                )
+        modelAdapter = self.create_model_adapter(sim_config, public_holidays_timestamps, calendarCache)
         X, Y = modelAdapter.transformData(all_standard_loadprofiles, weatherData=None)
-        pretraining_filename = 'scripts/outputs/standard_loadprofile.pkl'
-        with open(pretraining_filename, 'wb') as file:
-            pickle.dump((X, Y, modelAdapter), file)
-        
-        # If required, do pretraining
-        if sim_config.doPretraining:
+        self.featureStore.write(pretraining_filename, X, Y, modelAdapter)
+
+        return loadProfiles_filenames
+
+    # Transform the given community profiles (one column per community) and store them into the 
+    # feature store. The first column has the given community index.
+    #
+    def transform_communities(self, communityProfiles, first_index, sim_config, weatherData, 
+                              public_holidays_timestamps, calendarCache=None):
+
+        batchAdapter = self.create_model_adapter(sim_config, public_holidays_timestamps, calendarCache)
+        X_batch, Y_batch = batchAdapter.transformData(communityProfiles, weatherData)
+
+        loadProfiles_filenames = []
+        for i in range(communityProfiles.shape[1]):
             
-            # Do model pretraining
-            for model_type in sim_config.usedModels:
-                print(f"\nPretraining {model_type} model and and sim_config {act_sim_config_index+1}/{len(configs)}.", flush=True)
-                num_of_features = X['all'].shape[2]
-                myModel = model.Model(model_type, sim_config.modelSize, num_of_features)
-                myModel.train_model(X['all'], Y['all'], pretrain_now=True, 
-                                    finetune_now=False, epochs=sim_config.epochs)
+            # Get X, Y and the normalization of the current community
+            X = X_batch.getCommunity(i)
+            Y = Y_batch.getCommunity(i)
+            modelAdapter = batchAdapter.getCommunityAdapter(i)
+            
+            # The filename is kept as identifier of the profile in the results
+            out_filename = 'scripts/outputs/file_' + str(first_index + i) + '.pkl'
+            self.featureStore.write(out_filename, X, Y, modelAdapter)
+            loadProfiles_filenames.append(out_filename)
 
         return loadProfiles_filenames
 
+    def create_model_adapter(self, sim_config, public_holidays_timestamps, calendarCache=None):
+
+        modelAdapter = ModelAdapter.ModelAdapter(public_holidays_timestamps, 
+                                                 trainHistory = sim_config.trainingHistory,
+                                                 testSize = sim_config.testSize, 
+                                                 trainFuture = sim_config.trainingFuture, 
+                                                 devSize = sim_config.devSize, 
+                                                 calendarCache = calendarCache,
+                                                 )
+        return modelAdapter
+
+    # Return the preprocessing cache key of the given config, i.e. a hash of all settings that 
+    # affect the preprocessed data.
+    #
+    def get_preprocessing_key(self, sim_config):
+
+        settings = {field: getattr(sim_config, field) for field in ['aggregation_Count', 'nrOfComunities', 
+                    'trainingHistory', 'testSize', 'trainingFuture', 'devSize']}
+        settings.update(self.create_model_adapter(sim_config, []).getPreprocessingParameters())
+        settings['feature_encoding'] = self.featureStore.encoding
+        settings['weather_source'] = self.weatherMeasurements.source.get_id()
+        cache_key = self.preprocessingCache.getKey(settings, source_files=[sim_config.aggregation_Count])
+
+        return cache_key
+
     def load_data(self, sim_config):
         
         # Readout the power profiles, bring them to the format needed by the model and store those profiles
@@ -156,8 +469,7 @@ class ModelTrainer:
         #
         startDate = loadProfiles[0].index[0].to_pydatetime().replace(tzinfo=None)
         endDate = loadProfiles[0].index[-1].to_pydatetime().replace(tzinfo=None)
-        weather_measurements = weather_data.WeatherMeasurements()
-        weatherData = weather_measurements.get_data(
+        weatherData = self.weatherMeasurements.get_data(
                     startDate = startDate, 
                     endDate = endDate,
                     lat = 51.5085,      # Location:
@@ -181,6 +493,38 @@ class ModelTrainer:
 
         return loadProfiles, weatherData, public_holidays_timestamps
 
+# State of the preprocessing worker processes, which is set once per worker.
+#
+_preprocessing_worker_state = {}
+
+def _init_preprocessing_worker(modelTrainer, sim_config, weatherData, public_holidays_timestamps):
+    _preprocessing_worker_state['modelTrainer'] = modelTrainer
+    _preprocessing_worker_state['sim_config'] = sim_config
+    _preprocessing_worker_state['weatherData'] = weatherData
+    _preprocessing_worker_state['public_holidays_timestamps'] = public_holidays_timestamps
+    _preprocessing_worker_state['calendarCache'] = ModelAdapter.CalendarFeatureCache()
+
+def _transform_communities_in_worker(first_index, communityProfiles):
+    state = _preprocessing_worker_state
+    return state['modelTrainer'].transform_communities(communityProfiles, first_index, state['sim_config'], 
+                                                       state['weatherData'], state['public_holidays_timestamps'], 
+                                                       state['calendarCache'])
+
+# State of the training worker processes, which is set once per worker.
+#
+_training_worker_state = {}
+
+def _init_training_worker(modelTrainer, threads_per_worker):
+    torch.set_num_threads(threads_per_worker)
+    _training_worker_state['modelTrainer'] = modelTrainer
+
+# Not all models can be pickled (e.g. xLSTM), so the workers store their results and only return None.
+#
+def _run_training_job_in_worker(model_type, load_profiles, configs, act_sim_config_index, store_quantized):
+    modelTrainer = _training_worker_state['modelTrainer']
+    results = modelTrainer.run_training_job(model_type, load_profiles, configs, act_sim_config_index)
+    modelTrainer.store_results(results, isinstance(load_profiles, list), store_quantized)
+
 if __name__ == "__main__":
     configs = scripts.Simulation_config.configs
     ModelTrainer().run(configs)
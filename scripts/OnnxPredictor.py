@@ -0,0 +1,29 @@
+import numpy as np
+import onnxruntime as ort
+
+# Serve the forecasts of an exported model (see Model.export_onnx) with onnxruntime.
+#
+# Only numpy and onnxruntime are imported, i.e. the serving process doesn't need torch, xlstm, 
+# plotly or dash. If the model was exported with its ModelAdapter, the normalization is part 
+# of the graph: predict takes the raw features and returns the load in watts.
+#
+class OnnxPredictor:
+
+    def __init__(self, path, num_threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+
+    # Predict Y (days, timesteps, 1) from the given X (days, timesteps, features).
+    #
+    def predict(self, X):
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        output = self.session.run([self.output_name], {self.input_name: X})[0]
+
+        return output
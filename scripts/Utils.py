@@ -1,5 +1,8 @@
 
 import json
+import os
+import shutil
+import hashlib
 from datetime import datetime
 import torch
 import pickle
@@ -24,17 +27,37 @@ class Serialize:
 
     # Use torch to save a dictionary with training results to disc.
     # Especially useful for torch models.
+    # Optionally, the dynamically quantized (int8) pytorch models are stored next to it, 
+    # e.g. all_trained_models_int8.pth (see get_quantized_path).
     #
     @staticmethod
-    def store_results_with_torch(all_trained_models):      
+    def store_results_with_torch(all_trained_models, store_quantized=False):      
         
+        # Quantize the pytorch models
+        if store_quantized:
+            all_quantized_models = {key: scripts.Model.quantize_dynamic_module(model) 
+                                    for key, model in all_trained_models.items() if model.isPytorchModel}
+            all_quantized_models = Serialize.get_serialized_dicts(all_quantized_models, isModel = True)
+
         # Squeeze the dict keys
         all_trained_models = Serialize.get_serialized_dicts(all_trained_models, isModel = True)
 
         # Save the total model with torch.save
         timestamp = Serialize.get_act_timestamp()
-        torch.save(all_trained_models, f'scripts/outputs/all_trained_models{timestamp}.pth')
-        torch.save(all_trained_models, f'scripts/outputs/all_trained_models.pth')
+        Serialize.save_with_latest(torch.save, all_trained_models, 
+                                   f'scripts/outputs/all_trained_models{timestamp}.pth', 
+                                   f'scripts/outputs/all_trained_models.pth')
+        if store_quantized:
+            Serialize.save_with_latest(torch.save, all_quantized_models, 
+                                       f'scripts/outputs/all_trained_models{timestamp}_int8.pth', 
+                                       f'scripts/outputs/all_trained_models_int8.pth')
+
+    # Return the path of the quantized models, which belong to the given path of the trained models.
+    #
+    @staticmethod
+    def get_quantized_path(path_to_trained_parameters):
+        root, extension = os.path.splitext(path_to_trained_parameters)
+        return f'{root}_int8{extension}'
 
     # Use pickle to save a dictionary with training results to disc.
     #
@@ -46,10 +69,91 @@ class Serialize:
         
         # Store the variables in a persistent files with the timestamp
         timestamp = Serialize.get_act_timestamp()
-        with open(f"scripts/outputs/all_train_histories{timestamp}.pkl", 'wb') as f:
-            pickle.dump(all_train_histories, f)
-        with open(f"scripts/outputs/all_train_histories.pkl", 'wb') as f:
-            pickle.dump(all_train_histories, f)
+        Serialize.save_with_latest(Serialize.save_with_pickle, all_train_histories, 
+                                   f"scripts/outputs/all_train_histories{timestamp}.pkl", 
+                                   f"scripts/outputs/all_train_histories.pkl")
+
+    # Save the training telemetry (cost per epoch) of all given training histories as json.
+    #
+    @staticmethod
+    def store_telemetry_with_json(all_train_histories):
+        
+        all_telemetry = {Serialize.serialize_complex_key(key): history['telemetry'] 
+                         for key, history in all_train_histories.items() if 'telemetry' in history}
+        
+        timestamp = Serialize.get_act_timestamp()
+        Serialize.save_with_latest(Serialize.save_with_json, all_telemetry, 
+                                   f"scripts/outputs/training_telemetry{timestamp}.json", 
+                                   f"scripts/outputs/training_telemetry.json")
+
+    # Build the output files of a run (see above) from the results of the given keys in the ResultStore.
+    #
+    @staticmethod
+    def store_results_from_result_store(resultStore, result_keys):
+
+        all_train_histories = {key: resultStore.read_history(key) for key in result_keys}
+        Serialize.store_results_with_pickle(all_train_histories)
+        Serialize.store_telemetry_with_json(all_train_histories)
+        del all_train_histories
+
+        # The stored parameters are already state_dicts
+        timestamp = Serialize.get_act_timestamp()
+        all_trained_models = {Serialize.serialize_complex_key(key): resultStore.read_state_dict(key) 
+                              for key in result_keys}
+        Serialize.save_with_latest(torch.save, all_trained_models, 
+                                   f'scripts/outputs/all_trained_models{timestamp}.pth', 
+                                   f'scripts/outputs/all_trained_models.pth')
+        del all_trained_models
+        all_quantized_models = {Serialize.serialize_complex_key(key): resultStore.read_state_dict(key, quantized=True) 
+                                for key in result_keys if resultStore.contains_quantized(key)}
+        # Remove the int8 latest file of a previous run, so both latest files always describe the same run
+        if len(all_quantized_models) > 0:
+            Serialize.save_with_latest(torch.save, all_quantized_models, 
+                                       f'scripts/outputs/all_trained_models{timestamp}_int8.pth', 
+                                       f'scripts/outputs/all_trained_models_int8.pth')
+        elif os.path.lexists('scripts/outputs/all_trained_models_int8.pth'):
+            os.remove('scripts/outputs/all_trained_models_int8.pth')
+
+    # Save the given data to the (timestamped) path and replace the latest file by a link to it,
+    # i.e. the data is only written once.
+    # Both files are replaced atomically via a temporary file of this process. An existing file at
+    # the path (e.g. of a run in the same minute, which may be linked to the latest file) is replaced,
+    # but never overwritten in place.
+    #
+    @staticmethod
+    def save_with_latest(save, data, path, latest_path):
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            save(data, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if os.path.exists(latest_path) and os.path.samefile(path, latest_path):
+            return
+
+        tmp_path = f'{latest_path}.{os.getpid()}.tmp'
+        try:
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, latest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def save_with_pickle(data, path):
+        with open(path, 'wb') as f:
+            pickle.dump(data, f)
+
+    @staticmethod
+    def save_with_json(data, path):
+        with open(path, 'w') as f:
+            json.dump(data, f)
 
     # Serialize the given dicts.
     #
@@ -120,12 +224,18 @@ class Deserialize:
         return train_histories
     
     # Get the trained models from disc and deserialize/unpack them.
+    # With quantized=True, the int8 model is loaded, which was stored next to the given fp32 model.
     #
     @staticmethod
     def get_trained_model(path_to_trained_parameters, model_type, test_profile, 
-                          chosenConfig, num_of_features, modelAdapter):
+                          chosenConfig, num_of_features, modelAdapter, quantized=False):
         
-        serialized_dict = torch.load(path_to_trained_parameters)
+        if quantized:
+            # The packed int8 weights are (own) torch script objects, which need the full unpickler
+            serialized_dict = torch.load(Serialize.get_quantized_path(path_to_trained_parameters), 
+                                         weights_only=False)
+        else:
+            serialized_dict = torch.load(path_to_trained_parameters)
         
         for serialized_key, state_dict in serialized_dict.items():
             deserialize_key = Deserialize.deserialize_key(serialized_key)
@@ -137,6 +247,8 @@ class Deserialize:
                                             num_of_features=num_of_features,
                                             modelAdapter=modelAdapter
                                             )
+                if quantized:
+                    model = model.quantize()
                 model.my_model.load_state_dict(state_dict)
                 return model
         
@@ -174,6 +286,72 @@ class Deserialize:
             config_rebuilt
         )
 
+# Store the result (training history and trained parameters) of every single training job, as soon as
+# the job is finished. So an interrupted run can be resumed without losing the finished jobs and the 
+# results don't have to be kept in memory until the end of the run.
+#
+# Every result is a directory, which is named by the hash of its (model_type, load_profile, config) key 
+# and written atomically. The output files of a run are built from this store.
+#
+class ResultStore:
+
+    def __init__(self, path='scripts/outputs/results'):
+        self.path = path
+
+    # Store the history and the parameters of the given trained model (and optionally its int8 version).
+    # The optional training hash identifies how the result was trained (e.g. a hash of the preprocessed 
+    # profile and the training options).
+    #
+    def write(self, key, history, trained_model, store_quantized=False, training_hash=None):
+
+        entry_path = self.get_entry_path(key)
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        torch.save(trained_model.state_dict(), os.path.join(tmp_path, 'model.pth'))
+        if store_quantized and trained_model.isPytorchModel:
+            quantized_model = scripts.Model.quantize_dynamic_module(trained_model)
+            torch.save(quantized_model.state_dict(), os.path.join(tmp_path, 'model_int8.pth'))
+        with open(os.path.join(tmp_path, 'history.pkl'), 'wb') as f:
+            pickle.dump({'key': Serialize.serialize_complex_key(key), 'training_hash': training_hash, 'history': history}, f)
+
+        shutil.rmtree(entry_path, ignore_errors=True)
+        os.replace(tmp_path, entry_path)
+
+    # Return True, if a result of the given key is stored (and was trained with the given training hash).
+    #
+    def contains(self, key, training_hash=None):
+
+        history_path = os.path.join(self.get_entry_path(key), 'history.pkl')
+        if not os.path.exists(history_path):
+            return False
+        if training_hash is None:
+            return True
+
+        with open(history_path, 'rb') as f:
+            return pickle.load(f).get('training_hash') == training_hash
+
+    def contains_quantized(self, key):
+        return os.path.exists(os.path.join(self.get_entry_path(key), 'model_int8.pth'))
+
+    def read_history(self, key):
+        with open(os.path.join(self.get_entry_path(key), 'history.pkl'), 'rb') as f:
+            return pickle.load(f)['history']
+
+    # The packed int8 weights are (own) torch script objects, which need the full unpickler.
+    #
+    def read_state_dict(self, key, quantized=False):
+        if quantized:
+            return torch.load(os.path.join(self.get_entry_path(key), 'model_int8.pth'), weights_only=False)
+        else:
+            return torch.load(os.path.join(self.get_entry_path(key), 'model.pth'))
+
+    def get_entry_path(self, key):
+        key_hash = hashlib.sha256(Serialize.serialize_complex_key(key).encode()).hexdigest()[:32]
+        return os.path.join(self.path, key_hash)
+
+
 # Evaluate the stored training results 
 #
 class Evaluate_Models:
@@ -128,7 +128,7 @@ class PlotlyApp:
                 if selected_dataset != 'all':
                     print("Warning: Without given model, the visualiation only works for the 'all' dataset", flush=True)
             else:
-                Y_pred = self.model_plot.predict(X_selected)
+                Y_pred = self.model_plot.predict(X_selected, dates=self.modelAdapter.getStartDates(selected_dataset))
                 Y_pred = Y_pred[selected_date,:,0]
             Y_pred = self.modelAdapter.deNormalizeY(Y_pred)
 
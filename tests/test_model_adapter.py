@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+import torch
+import sys
+import os
+
+# Make sure, that the root of the project is already in PYTHONPATH.
+#
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+import scripts.ModelAdapter as ModelAdapter
+
+# Reference implementation of the feature construction, i.e. the original per-batch loop.
+#
+def reference_formattingX(adapter, weatherData, powerProfiles):
+
+    nr_of_features = 11 + 3
+    if weatherData is None:
+        num_of_weather_features = 6
+    else:
+        num_of_weather_features = weatherData.shape[1]
+    nr_of_features += num_of_weather_features
+
+    nr_of_timesteps = len(pd.date_range(start=adapter.first_prediction_date,
+                                        end=adapter.first_prediction_date + adapter.prediction_horizon,
+                                        freq=adapter.sampling_time))
+    X_all = []
+    next_prediction_date = adapter.first_prediction_date
+    while next_prediction_date + adapter.prediction_horizon <= adapter.last_available_datetime:
+
+        X = np.zeros(shape=(nr_of_timesteps, nr_of_features))
+        total_input_range = pd.date_range(start=next_prediction_date,
+                                          end=next_prediction_date + adapter.prediction_horizon,
+                                          freq=adapter.sampling_time)
+
+        weekday_numbers = total_input_range.weekday.values.copy()
+        weekday_numbers[total_input_range.floor("D").isin(adapter.public_holidays)] = 6
+        X[:, :7] = np.eye(7)[weekday_numbers]
+        X[:, 7] = np.sin(2 * np.pi * total_input_range.hour / 24.0)
+        X[:, 8] = np.cos(2 * np.pi * total_input_range.hour / 24.0)
+        X[:, 9] = np.sin(2 * np.pi * total_input_range.day_of_year / 366)
+        X[:, 10] = np.cos(2 * np.pi * total_input_range.day_of_year / 366)
+        index = 11
+
+        for day in range(1, 4):
+            start = next_prediction_date - pd.Timedelta(days=day*7)
+            X[:, index] = powerProfiles.loc[start:start + adapter.prediction_horizon].values
+            index += 1
+
+        if weatherData is not None:
+            weatherData_slice = weatherData.loc[next_prediction_date - adapter.prediction_horizon:next_prediction_date]
+            X[:weatherData_slice.shape[0], index:] = weatherData_slice.values
+
+        X_all.append(X)
+        next_prediction_date += adapter.prediction_rate
+
+    return np.array(X_all)
+
+def reference_formattingY(adapter, powerProfiles):
+
+    Y_all = []
+    next_prediction_date = adapter.first_prediction_date
+    while next_prediction_date + adapter.prediction_horizon <= adapter.last_available_datetime:
+        Y_all.append(powerProfiles.loc[next_prediction_date:next_prediction_date + adapter.prediction_horizon].values)
+        next_prediction_date += adapter.prediction_rate
+
+    return np.array(Y_all)[:, :, np.newaxis]
+
+def make_data(days=120, weather_gaps=False, seed=0):
+
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('2012-01-01', periods=days*48, freq='30min', tz='UTC')
+    powerProfile = pd.Series(rng.random(len(index)), index=index)
+    weather_index = pd.date_range('2011-12-31', periods=(days + 2)*24, freq='h', tz='UTC')
+    weatherData = pd.DataFrame(rng.random((len(weather_index), 6)), index=weather_index, columns=list('abcdef'))
+    if weather_gaps:
+        weatherData = weatherData.drop(weatherData.index[rng.choice(len(weatherData), 200, replace=False)])
+    public_holidays = [pd.Timestamp(day, tzinfo=pytz.utc) for day in ['2012-01-02', '2012-04-06']]
+
+    return powerProfile, weatherData, public_holidays
+
+@pytest.mark.parametrize('prediction_rate', [pd.Timedelta(days=1), pd.Timedelta(hours=12)])
+@pytest.mark.parametrize('weather', ['complete', 'gaps', 'none'])
+def test_transform_data_matches_reference(prediction_rate, weather):
+
+    powerProfile, weatherData, public_holidays = make_data(weather_gaps=(weather == 'gaps'))
+    if weather == 'none':
+        weatherData = None
+    adapter = ModelAdapter.ModelAdapter(public_holidays, trainHistory=40, testSize=20, devSize=10, trainFuture=5,
+                                        prediction_rate=prediction_rate)
+    X, Y = adapter.transformData(powerProfile, weatherData)
+
+    # Build the reference features on the same (resampled) profile
+    resampledProfile = powerProfile.resample(adapter.sampling_time).mean()
+    X_ref = reference_formattingX(adapter, weatherData, resampledProfile)
+    Y_ref = reference_formattingY(adapter, resampledProfile)
+    assert X['all'].shape == X_ref.shape
+    assert Y['all'].shape == Y_ref.shape
+
+    # The statistics are estimated on the train set
+    X_train, Y_train = X_ref[adapter.getSplitIndices()['train']], Y_ref[adapter.getSplitIndices()['train']]
+    stdX = np.std(X_train, axis=(0, 1))
+    stdX = np.where(np.isclose(stdX, 0), 1e-8, stdX)
+    np.testing.assert_allclose(adapter.meanX, np.mean(X_train, axis=(0, 1)), atol=1e-6)
+    np.testing.assert_allclose(adapter.stdX, stdX, atol=1e-6)
+    np.testing.assert_allclose(adapter.meanY, np.mean(Y_train, axis=(0, 1)), atol=1e-6)
+    np.testing.assert_allclose(adapter.stdY, np.std(Y_train), atol=1e-6)
+
+    # Compare the de-normalized float32 data with the float64 reference
+    assert X['all'].dtype == Y['all'].dtype == torch.float32
+    np.testing.assert_allclose(adapter.deNormalizeX(X['all'].numpy()), X_ref, atol=1e-5)
+    np.testing.assert_allclose(adapter.deNormalizeY(Y['all'].numpy()), Y_ref, atol=1e-5)
+
+    # All splits are consistent with the shared data
+    for dataset_type in ['train', 'dev', 'test']:
+        indices = adapter.getSplitIndices()[dataset_type]
+        np.testing.assert_array_equal(X[dataset_type].numpy(), X['all'].numpy()[indices])
@@ -0,0 +1,76 @@
+import torch
+import pytest
+import sys
+import os
+
+# Make sure, that the root of the project is already in PYTHONPATH.
+#
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+import scripts.Model as model
+
+NR_OF_COMMUNITIES = 3
+NR_OF_SAMPLES = 40
+NUM_OF_FEATURES = 20
+
+# Disable the dropout, as the vectorized training shares the dropout masks of all communities.
+#
+def disable_dropout(my_model):
+    for module in my_model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.0
+        elif isinstance(module, torch.nn.MultiheadAttention):
+            module.dropout = 0.0
+
+# Train the communities once with the MultiCommunityModel and once independently with Model.train_model,
+# using the same initial weights and the same (fixed) permutation of the samples in every epoch.
+#
+def train_both(model_type, monkeypatch):
+
+    torch.manual_seed(0)
+    X = torch.randn(NR_OF_COMMUNITIES, NR_OF_SAMPLES, 24, NUM_OF_FEATURES)
+    Y = torch.randn(NR_OF_COMMUNITIES, NR_OF_SAMPLES, 24, 1)
+    initial_weights = model.Model(model_type, '1k', NUM_OF_FEATURES).my_model.state_dict()
+    permutation = torch.randperm(NR_OF_SAMPLES)
+    monkeypatch.setattr(torch, 'randperm', lambda n: permutation[:n].clone())
+    training_options = dict(finetune_now=True, pretrained_weights=initial_weights, epochs=3, batch_size=16)
+
+    multiModel = model.MultiCommunityModel(model_type, '1k', NUM_OF_FEATURES, [None] * NR_OF_COMMUNITIES)
+    for myModel in multiModel.models:
+        disable_dropout(myModel.my_model)
+    joint_histories = multiModel.train_model(X, Y, **training_options)
+
+    independent_models, independent_histories = [], []
+    for i in range(NR_OF_COMMUNITIES):
+        myModel = model.Model(model_type, '1k', NUM_OF_FEATURES)
+        disable_dropout(myModel.my_model)
+        independent_histories.append(myModel.train_model(X[i], Y[i], **training_options))
+        independent_models.append(myModel)
+
+    return multiModel, joint_histories, independent_models, independent_histories
+
+@pytest.mark.parametrize('model_type', ['LSTM', 'Transformer'])
+def test_vectorized_training_matches_independent_training(model_type, monkeypatch):
+
+    multiModel, joint_histories, independent_models, independent_histories = train_both(model_type, monkeypatch)
+    assert multiModel.vectorize
+
+    # The vectorized operations round differently, which Adam amplifies for near-zero gradients
+    for i in range(NR_OF_COMMUNITIES):
+        assert joint_histories[i]['loss'] == pytest.approx(independent_histories[i]['loss'], rel=1e-4)
+        joint_state = multiModel.models[i].my_model.state_dict()
+        for name, value in independent_models[i].my_model.state_dict().items():
+            torch.testing.assert_close(joint_state[name], value, rtol=1e-3, atol=1e-3)
+
+def test_grouped_training_equals_independent_training(monkeypatch):
+
+    multiModel, joint_histories, independent_models, independent_histories = train_both('xLSTM', monkeypatch)
+    assert not multiModel.vectorize
+
+    for i in range(NR_OF_COMMUNITIES):
+        assert joint_histories[i]['loss'] == independent_histories[i]['loss']
+        joint_state = multiModel.models[i].my_model.state_dict()
+        for name, value in independent_models[i].my_model.state_dict().items():
+            assert torch.equal(joint_state[name], value), name
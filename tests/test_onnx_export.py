@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+import pytest
+import types
+import sys
+import os
+
+# Make sure, that the root of the project is already in PYTHONPATH.
+#
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+pytest.importorskip('onnxruntime')
+
+import scripts.Model as model
+import scripts.OnnxPredictor as OnnxPredictor
+
+NUM_OF_FEATURES = 20
+
+# Normalization statistics like those of a ModelAdapter, so the normalization is part of the exported graph.
+#
+def create_statistics():
+    rng = np.random.default_rng(0)
+    return types.SimpleNamespace(meanX=rng.random(NUM_OF_FEATURES).astype(np.float32),
+                                 stdX=(rng.random(NUM_OF_FEATURES) + 0.5).astype(np.float32),
+                                 meanY=np.float32(300.0), stdY=np.float32(50.0))
+
+@pytest.mark.parametrize('model_type', ['LSTM', 'Transformer', 'xLSTM'])
+@pytest.mark.parametrize('normalized', [False, True])
+def test_onnx_predictor_matches_torch(model_type, normalized, tmp_path):
+
+    torch.manual_seed(0)
+    modelAdapter = create_statistics() if normalized else None
+    myModel = model.Model(model_type, '5k', NUM_OF_FEATURES, modelAdapter=modelAdapter)
+    path = myModel.export_onnx(str(tmp_path / f'{model_type}.onnx'), check_parity=False)
+
+    # Compare on new data with another number of days than exported
+    torch_model = myModel.get_normalized_model() if normalized else myModel.my_model
+    torch_model.eval()
+    X = torch.randn(7, 24, NUM_OF_FEATURES)
+    if normalized:
+        X = X * torch.as_tensor(modelAdapter.stdX) + torch.as_tensor(modelAdapter.meanX)
+    with torch.no_grad():
+        expected = torch_model(X).numpy()
+    received = OnnxPredictor.OnnxPredictor(path).predict(X.numpy())
+
+    assert received.shape == expected.shape == (7, 24, 1)
+    np.testing.assert_allclose(received, expected, rtol=1e-4, atol=1e-4 * float(np.abs(expected).max()))